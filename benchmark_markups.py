@@ -0,0 +1,248 @@
+""" Benchmark for markup preprocess and load pipeline
+
+Generates synthetic markup.csv and rules.csv, uploads them to a local S3 stand-in (moto server or MinIO)
+and runs preprocessing and loading stages against a local Postgres.
+
+    AWS_ENDPOINT_URL=http://localhost:9000 AWS_BUCKET_NAME=benchmark \\
+    python benchmark_markups.py --rows 10000 100000 1000000 --type crm --models 5 --segments 10
+"""
+from preprocess_ml_script import PreprocessML
+from load_markups import LoadData
+from db.db import connect_db_data
+from bucket import Bucket
+from markup_files import count_rows
+from datetime import datetime
+import multiprocessing
+import psycopg2.extras
+import argparse
+import resource
+import random
+import boto3
+import json
+import time
+import csv
+import os
+
+SEARCH_NAMES = {'crm': 'eshop_customer_id', 'beh': 'guest_id'}
+
+
+class CallCounter:
+    """ Counting S3 calls and DB round trips """
+    s3_calls = 0
+    db_round_trips = 0
+
+    @classmethod
+    def count_s3_call(cls, **kwargs):
+        cls.s3_calls += 1
+
+    @classmethod
+    def snapshot(cls):
+        return cls.s3_calls, cls.db_round_trips
+
+
+class CountingDictCursor(psycopg2.extras.DictCursor):
+    """ DictCursor counting statements sent to server """
+
+    def execute(self, query, vars=None):
+        CallCounter.db_round_trips += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        CallCounter.db_round_trips += 1
+        return super().executemany(query, vars_list)
+
+
+class BenchmarkPreprocessML(PreprocessML):
+    """ PreprocessML with eshop data taken from arguments instead of auth API """
+
+    def __init__(self, markup_type, account_id, eshop_id, **kwargs):
+        self.benchmark_eshop_id = eshop_id
+        super().__init__(markup_type, account_id, **kwargs)
+
+    def _get_eshop_data(self, account_id):
+        return {'id': self.benchmark_eshop_id, 'shop_platform_id': 1}
+
+
+def install_counters():
+    """ Count S3 calls on default boto3 session and DB statements on DictCursor """
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-call.s3', CallCounter.count_s3_call)
+    psycopg2.extras.DictCursor = CountingDictCursor
+
+
+def reset_peak_rss():
+    """ Reset peak resident memory of the process on Linux, so peak is measured per stage """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss_mb():
+    """ Peak resident memory of the process in MB since last reset_peak_rss """
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 2)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+
+
+def generate_files(directory, rows, markup_type, models, segments, customers, seed):
+    """ Generate synthetic markup and rules files """
+    randomizer = random.Random(seed)
+    model_names = [f"model_{model_number}" for model_number in range(models)]
+    predicted_values = {(model, segment): round(randomizer.random(), 4)
+                        for model in model_names for segment in range(segments)}
+    markup_path = f"{directory}/markup.csv"
+    rules_path = f"{directory}/rules.csv"
+    with open(markup_path, 'w', newline='') as markup_file:
+        writer = csv.writer(markup_file)
+        writer.writerow([SEARCH_NAMES[markup_type], 'model', 'segment', 'predicted_value'])
+        for _ in range(rows):
+            model = randomizer.choice(model_names)
+            segment = randomizer.randrange(segments)
+            writer.writerow([randomizer.randrange(customers), model, segment, predicted_values[(model, segment)]])
+    with open(rules_path, 'w', newline='') as rules_file:
+        writer = csv.writer(rules_file)
+        writer.writerow(['model', 'segment', 'description'])
+        for model, segment in predicted_values:
+            writer.writerow([model, segment, f"{model} segment {segment}"])
+    return markup_path, rules_path
+
+
+def seed_profiles(markup_type, account_id, eshop_id, eshop_prefix, customers, match_rate, seed):
+    """ Insert customer profiles matching share of synthetic customers """
+    randomizer = random.Random(seed)
+    db_connect_data = connect_db_data(cursor_factory=psycopg2.extras.DictCursor)
+    matched = [customer for customer in range(customers) if randomizer.random() < match_rate]
+    if markup_type == 'crm':
+        query = """ INSERT INTO data.customer_profile_crm (customer_profile_id, eshop_customer_id, eshop_id)
+        VALUES %s ON CONFLICT DO NOTHING """
+        data = [(customer, f"{eshop_prefix}{customer}", eshop_id) for customer in matched]
+    else:
+        query = """ INSERT INTO data.customer_profile_behaviour (customer_profile_id, guest_id, account_id)
+        VALUES %s ON CONFLICT DO NOTHING """
+        data = [(customer, str(customer), account_id) for customer in matched]
+    psycopg2.extras.execute_values(db_connect_data.cursor, query, data, page_size=10000)
+    db_connect_data.connection.commit()
+    db_connect_data.cursor.close()
+    return len(matched)
+
+
+def run_stage(stages, name, rows, function, *args):
+    """ Run pipeline stage and collect its metrics """
+    s3_calls, db_round_trips = CallCounter.snapshot()
+    peak_rss_reset = reset_peak_rss()
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    stages[name] = {
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'rows_per_second': round(rows / seconds, 2) if seconds else None,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'peak_rss_per_stage': peak_rss_reset,
+        'db_round_trips': CallCounter.db_round_trips - db_round_trips,
+        's3_calls': CallCounter.s3_calls - s3_calls,
+        'result': result
+    }
+    print(f"{name}: {stages[name]}")
+    return result
+
+
+def time_search_calls(preprocess, search_stats):
+    """ Accumulate time spent in _search_customer_profile_id """
+    search_customer_profile_id = preprocess._search_customer_profile_id
+
+    def timed_search(queries, data, data_row, *args):
+        s3_calls, db_round_trips = CallCounter.snapshot()
+        start = time.perf_counter()
+        result = search_customer_profile_id(queries, data, data_row, *args)
+        search_stats['seconds'] += time.perf_counter() - start
+        search_stats['rows'] += len(data_row)
+        search_stats['calls'] += 1
+        search_stats['db_round_trips'] += CallCounter.db_round_trips - db_round_trips
+        search_stats['s3_calls'] += CallCounter.s3_calls - s3_calls
+        return result
+
+    preprocess._search_customer_profile_id = timed_search
+
+
+def run_benchmark(options, rows):
+    """ Run all stages for one markup size in a separate process """
+    install_counters()
+    stages = dict()
+    account_id = options.account_id
+    timestamp = str(int(time.time()))
+    bucket = Bucket(os.getenv('AWS_BUCKET_NAME'))
+    # negative cache persists in bucket between runs and would skip lookups measured by earlier runs,
+    # DB and S3 calls are counted in this process only, so markup is not sharded to workers
+    preprocess = BenchmarkPreprocessML(options.type, account_id, options.eshop_id, workers=1,
+                                       use_negative_cache=False)
+    directory = preprocess.temp_dir.name
+    markup_path, rules_path = generate_files(directory, rows, options.type, options.models, options.segments,
+                                             options.customers, options.seed)
+    if options.seed_profiles:
+        seed_profiles(options.type, account_id, options.eshop_id, preprocess.eshop_prefix, options.customers,
+                      options.match_rate, options.seed)
+    bucket_folder = f"models/{account_id}/{options.type}/{timestamp}"
+    bucket.add_file(markup_path, f"{bucket_folder}/markup.csv")
+    bucket.add_file(rules_path, f"{bucket_folder}/rules.csv")
+    preprocess.folder_list, preprocess.timestamp = preprocess.load_directories(preprocess.path_bucket_folder)
+
+    search_stats = {'rows': 0, 'calls': 0, 'seconds': 0.0, 'db_round_trips': 0, 's3_calls': 0}
+    time_search_calls(preprocess, search_stats)
+    run_stage(stages, 'generate_new_markup', rows, preprocess.generate_new_markup, markup_path)
+    search_stats['seconds'] = round(search_stats['seconds'], 4)
+    search_stats['rows_per_second'] = round(search_stats['rows'] / search_stats['seconds'], 2) \
+        if search_stats['seconds'] else None
+    stages['_search_customer_profile_id'] = search_stats
+    run_stage(stages, 'generate_new_rules', options.models * options.segments, preprocess.generate_new_rules,
+              rules_path)
+
+    loader = LoadData(options.type, account_id)
+    run_stage(stages, 'load_segments', options.models * options.segments, loader.load_segments,
+              f"{directory}/preprocessed_rules.csv")
+    preprocessed_markup_path = f"{directory}/preprocessed_markup.csv"
+    run_stage(stages, 'load_markups', count_rows(preprocessed_markup_path, preprocessed_markup_path),
+              loader.load_markups, preprocessed_markup_path)
+    loader.db_connect_data.cursor.close()
+    preprocess.temp_dir.cleanup()
+    return {'rows': rows, 'timestamp': timestamp, 'stages': stages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark markup preprocess and load pipeline')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--type', choices=list(SEARCH_NAMES), default='crm')
+    parser.add_argument('--models', type=int, default=5)
+    parser.add_argument('--segments', type=int, default=10)
+    parser.add_argument('--customers', type=int, default=100000)
+    parser.add_argument('--account-id', default='benchmark')
+    parser.add_argument('--eshop-id', type=int, default=803)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--seed-profiles', action='store_true')
+    parser.add_argument('--match-rate', type=float, default=0.8)
+    parser.add_argument('--output', default=None)
+    options = parser.parse_args()
+
+    report = {'started_at': datetime.now().isoformat(), 'parameters': vars(options), 'runs': list()}
+    for rows in options.rows:
+        print(f"Benchmark for {rows} rows")
+        with multiprocessing.Pool(1) as pool:
+            report['runs'].append(pool.apply(run_benchmark, (options, rows)))
+
+    output = options.output or f"benchmark_results/markups_{options.type}_{int(time.time())}.json"
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2, default=str)
+    print(f"Benchmark results saved: {output}")
+
+
+if __name__ == '__main__':
+    main()
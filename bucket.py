@@ -1,63 +1,96 @@
-from dotenv import load_dotenv
-from botocore.exceptions import ClientError
 from datetime import datetime, timedelta
+from instrumentation import metrics, timed
+from functools import lru_cache
 import os
-import boto3
 
 
-load_dotenv()
+@lru_cache(maxsize=None)
+def load_environment():
+    """ Load .env once, on first use instead of module import """
+    from dotenv import load_dotenv
+    load_dotenv()
 
 
 class Bucket:
     """ Managing to S3 bucket """
 
     def __init__(self, name: str):
+        load_environment()
+        self._client = None
+        self._resource = None
         self.aws_access_key_id = os.getenv("AWS_ACCESS_KEY_ID")
         self.secret_aws_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
         self.region_name = os.getenv("AWS_REGION_NAME")
+        self.endpoint_url = os.getenv("AWS_ENDPOINT_URL")
         self.bucket_name = name
 
     def _connect_to_client(self):
-        """ Connect to s3 bucket client """
-
-        return boto3.client(
-            's3',
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.secret_aws_access_key,
-            region_name='us-west-2'
-        )
+        """ Connect to s3 bucket client, client is created once per bucket """
+        if self._client is None:
+            import boto3
+            self._client = boto3.client(
+                's3',
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.secret_aws_access_key,
+                region_name='us-west-2',
+                endpoint_url=self.endpoint_url
+            )
+        return self._client
 
     def _connect_to_resource(self):
-        """ Connect to s3 bucket resource """
-
-        return boto3.resource(
-            's3',
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.secret_aws_access_key,
-            region_name='us-west-2'
-        )
+        """ Connect to s3 bucket resource, resource is created once per bucket """
+        if self._resource is None:
+            import boto3
+            self._resource = boto3.resource(
+                's3',
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.secret_aws_access_key,
+                region_name='us-west-2',
+                endpoint_url=self.endpoint_url
+            )
+        return self._resource
 
     def delete_old_markups(self, path_to_folder: str, till_date: int):
-        folders = self._connect_to_client().list_objects(Bucket=self.bucket_name, Prefix=path_to_folder)
+        """ Delete timestamp folders older than till_date days, see retention.RetentionEngine for policies """
         folder_level = len(path_to_folder.split('/'))
         expire_date = datetime.now() - timedelta(days=till_date)
         timestamp_expire_date = round(datetime.timestamp(expire_date))
-        temp = dict()
-        if folders.get('Contents'):
-            for item in folders.get('Contents'):
-                timestamp_folder = item.get('Key').split('/')[folder_level:]
-                if timestamp_folder[0] not in temp:
-                    temp[timestamp_folder[0]] = []
-                temp[timestamp_folder[0]].append(timestamp_folder[1])
-            for temp_item_key, temp_item_value in temp.items():
-                if temp_item_key <= str(timestamp_expire_date):
-                    for file in temp_item_value:
-                        self.delete_file(f"{path_to_folder}/{temp_item_key}/{file}")
-                    print(f"{path_to_folder}/{temp_item_key}")
-                    self.delete_file(f"{path_to_folder}/{temp_item_key}")
+        keys = list()
+        for key in self.list_all_objects(path_to_folder):
+            timestamp_folder = key.split('/')[folder_level:]
+            if timestamp_folder and timestamp_folder[0].isdigit() and int(timestamp_folder[0]) <= timestamp_expire_date:
+                keys.append(key)
+        self.delete_files(keys)
+        return keys
+
+    def list_all_objects(self, prefix: str):
+        """ Iterate all keys under prefix with paginated listing """
+        paginator = self._connect_to_client().get_paginator('list_objects_v2')
+        pages = iter(paginator.paginate(Bucket=self.bucket_name, Prefix=prefix))
+        while True:
+            with metrics.timer('s3.list_objects_v2'):
+                page = next(pages, None)
+            if page is None:
+                break
+            for item in page.get('Contents', []):
+                yield item.get('Key')
+
+    def delete_files(self, keys: list, batch_size: int = 1000):
+        """ Delete files from bucket by batches, returns keys that were not deleted """
+        errors = list()
+        for start in range(0, len(keys), batch_size):
+            batch = [{'Key': key} for key in keys[start:start + batch_size]]
+            with metrics.timer('s3.delete_objects'):
+                response = self._connect_to_client().delete_objects(Bucket=self.bucket_name,
+                                                                    Delete={'Objects': batch, 'Quiet': True})
+            for error in response.get('Errors', []):
+                print(f"{error.get('Code')}: {error.get('Key')} - {error.get('Message')}")
+                errors.append(error.get('Key'))
+        return errors
 
     def load_directories(self, path_to_folder: str):
-        folders = self._connect_to_client().list_objects(Bucket=self.bucket_name, Prefix=path_to_folder)
+        with metrics.timer('s3.list_objects'):
+            folders = self._connect_to_client().list_objects(Bucket=self.bucket_name, Prefix=path_to_folder)
         folder_level = len(path_to_folder.split('/'))
         folders_list = dict()
         latest_timestamp_folder = None
@@ -76,7 +109,8 @@ class Bucket:
     def get_list_objects_folder(self, path: str):
         prefix = f"{path}"
         folder_list_object = list()
-        folder = self._connect_to_client().list_objects(Bucket=self.bucket_name, Prefix=prefix)
+        with metrics.timer('s3.list_objects'):
+            folder = self._connect_to_client().list_objects(Bucket=self.bucket_name, Prefix=prefix)
         if folder.get('Contents'):
             for item in folder.get('Contents'):
                 if item.get('Key'):
@@ -84,24 +118,30 @@ class Bucket:
                         folder_list_object.append(item.get('Key'))
         return folder_list_object
 
+    @timed('s3.get_object')
     def get_file(self, file_path):
+        from botocore.exceptions import ClientError
         try:
             return self._connect_to_resource().Object(self.bucket_name, file_path).get()['Body']
         except ClientError as boto_error:
             print(f"{boto_error}: {file_path}")
             return None
 
+    @timed('s3.upload_file')
     def add_file(self, file_path, path_in_bucket):
         with open(file_path, 'rb') as data:
             self._connect_to_client().upload_fileobj(data, self.bucket_name, path_in_bucket)
 
+    @timed('s3.copy_object')
     def copy_file(self, old_path,  new_path):
         """ Copy file in bucket """
+        from botocore.exceptions import ClientError
         try:
             self._connect_to_resource().meta.client.copy({'Bucket': self.bucket_name, 'Key': old_path}, self.bucket_name, new_path)
         except ClientError as boto_error:
             print(boto_error)
 
+    @timed('s3.delete_object')
     def delete_file(self, path):
         """ Delete file from bucket """
         self._connect_to_resource().Object(self.bucket_name, path).delete()
@@ -113,13 +153,15 @@ class Bucket:
 
     def get_files_from_dir(self, folder_path, destination_path):
         """ Download files from bucket to local folder"""
-        folders = self._connect_to_client().list_objects(Bucket=self.bucket_name, Prefix=folder_path)
+        with metrics.timer('s3.list_objects'):
+            folders = self._connect_to_client().list_objects(Bucket=self.bucket_name, Prefix=folder_path)
         if folders.get('Contents'):
             for item in folders.get('Contents'):
                 if item.get('Key'):
                     file_name = item.get('Key').split('/')[-1]
-                    self._connect_to_client().download_file(self.bucket_name, item.get('Key'),
-                                                            f"{destination_path}/{file_name}")
+                    with metrics.timer('s3.download_file'):
+                        self._connect_to_client().download_file(self.bucket_name, item.get('Key'),
+                                                                f"{destination_path}/{file_name}")
 
     def load_files_to_bucket(self, local_dir_path, bucket_path):
         """ Load all files from local directory to bucket"""
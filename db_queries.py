@@ -0,0 +1,40 @@
+import hashlib
+
+
+def array_literal(values):
+    """ Postgres array literal, typed by server from statement parameter like a quoted value """
+    items = list()
+    for value in values:
+        items.append('"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return '{' + ','.join(items) + '}'
+
+
+class PreparedQueries:
+    """ Server-side prepared statements for repeated query shapes on one DB connection """
+
+    def __init__(self, db_connect_data):
+        self.db_connect_data = db_connect_data
+        self.prepared = set()
+
+    @staticmethod
+    def statement_name(query):
+        return 'statement_' + hashlib.md5(query.encode()).hexdigest()[:16]
+
+    def execute(self, query, params=()):
+        """ Execute query with $1..$n placeholders, statement is prepared once per connection """
+        cursor = self.db_connect_data.cursor
+        name = self.statement_name(query)
+        if name not in self.prepared:
+            cursor.execute(f"PREPARE {name} AS {query}")
+            self.prepared.add(name)
+        if params:
+            cursor.execute(f"EXECUTE {name} ({','.join(['%s'] * len(params))})", tuple(params))
+        else:
+            cursor.execute(f"EXECUTE {name}")
+        return cursor
+
+    def fetchone(self, query, params=()):
+        return self.execute(query, params).fetchone()
+
+    def fetchall(self, query, params=()):
+        return self.execute(query, params).fetchall()
@@ -136,49 +136,91 @@ def send_request_to_server(url, data=None, headers=None, login=None, password=No
     return response
 
 
-def send_order_to_server(order_id):
-    """ Send order to 1C """
+ORDER_HEADERS = {
+    'Content-Type': 'application/json',
+    'X-WC-Webhook-Source': 'https://skyprofil.by/',
+}
+
+
+def get_order_queryset():
+    """ Orders with filial and cart lines loaded for 1C payload """
+    return Order.objects.select_related('filial_id').prefetch_related('order_cart')
+
+
+def get_order_data(order_item: Order):
+    """ Build 1C payload for order loaded by get_order_queryset """
     collect_data = dict()
-    headers = {
-        'Content-Type': 'application/json',
-        'X-WC-Webhook-Source': 'https://skyprofil.by/',
-    }
-    try:
-        order_item = Order.objects.prefetch_related('order_cart').get(id=order_id)
-        collect_data['id'] = order_item.id
-        collect_data['date_created'] = str(order_item.date_order).replace(' ', 'T')
-        collect_data['total'] = str(order_item.total())
-        collect_data['shipping_total'] = str(order_item.delivery_price) if order_item.delivery_price else None
-        collect_data['customer_id'] = None
-        collect_data['customer_note'] = order_item.additional_information
-        collect_data['shipping'] = dict()
-        collect_data['shipping'].update({
-            'address_1': order_item.delivery_address
+    collect_data['id'] = order_item.id
+    collect_data['date_created'] = str(order_item.date_order).replace(' ', 'T')
+    collect_data['total'] = str(order_item.total())
+    collect_data['shipping_total'] = str(order_item.delivery_price) if order_item.delivery_price else None
+    collect_data['customer_id'] = None
+    collect_data['customer_note'] = order_item.additional_information
+    collect_data['shipping'] = dict()
+    collect_data['shipping'].update({
+        'address_1': order_item.delivery_address
+    })
+    collect_data['billing'] = dict()
+    collect_data['billing'].update({
+        'first_name': order_item.fio,
+        'email': order_item.email,
+        'phone': order_item.phone
+    })
+    if order_item.filial_id:
+        collect_data['shipping_lines'] = list()
+        if order_item.delivery_address:
+            filial_address = "Доставка из " + order_item.delivery_address
+        else:
+            filial_address = "Самовывоз из " + order_item.filial_id.address
+        collect_data['shipping_lines'].append({
+            'method_title': filial_address
         })
-        collect_data['billing'] = dict()
-        collect_data['billing'].update({
-            'first_name': order_item.fio,
-            'email': order_item.email,
-            'phone': order_item.phone
+    collect_data['line_items'] = list()
+    for cart_item in order_item.order_cart.all():
+        collect_data['line_items'].append({
+            'quantity': cart_item.quantity,
+            'total': str(cart_item.total_price()),
+            'variation_id': cart_item.variation_id_id,
+            'product_id': cart_item.product_id_id
         })
-        if order_item.filial_id:
-            collect_data['shipping_lines'] = list()
-            if order_item.delivery_address:
-                filial_address = "Доставка из " + order_item.delivery_address
-            else:
-                filial_address = "Самовывоз из " + order_item.filial_id.address
-            collect_data['shipping_lines'].append({
-                'method_title': filial_address
-            })
-        collect_data['line_items'] = list()
-        for cart_item in order_item.order_cart.all():
-            collect_data['line_items'].append({
-                'quantity': cart_item.quantity,
-                'total': str(cart_item.total_price()),
-                'variation_id': cart_item.variation_id_id,
-                'product_id': cart_item.product_id_id
-            })
-        return send_request_to_server('/skyprofil-noauth/hs/wcwhv2/order.created', collect_data,
-                                      headers=headers, method='post')
+    return collect_data
+
+
+def get_orders_data(order_ids: list):
+    """ Build 1C payloads for many orders at once, keyed by order id """
+    result = dict()
+    for order_item in get_order_queryset().filter(id__in=order_ids).order_by('id'):
+        result[order_item.id] = get_order_data(order_item)
+    return result
+
+
+def send_order_to_server(order_id):
+    """ Send order to 1C """
+    try:
+        order_item = get_order_queryset().get(id=order_id)
+        return send_request_to_server('/skyprofil-noauth/hs/wcwhv2/order.created', get_order_data(order_item),
+                                      headers=ORDER_HEADERS, method='post')
     except Order.DoesNotExist:
         pass
+
+
+def send_orders_to_server(order_ids: list):
+    """ Resend backlog of orders to 1C, failed and not found orders are returned with error message """
+    result = dict()
+    error_message = list()
+    production_logging = logging.getLogger('production')
+    orders_data = get_orders_data(order_ids)
+    for order_id in order_ids:
+        if order_id not in orders_data:
+            result[order_id] = {'error_message': f"order_id: {order_id} - order not found"}
+            error_message.append(result[order_id]['error_message'])
+    for order_id, collect_data in orders_data.items():
+        try:
+            result[order_id] = {'result': send_request_to_server('/skyprofil-noauth/hs/wcwhv2/order.created',
+                                                                 collect_data, headers=ORDER_HEADERS, method='post')}
+        except requests.exceptions.RequestException as error:
+            result[order_id] = {'error_message': f"order_id: {order_id} - {error}"}
+            error_message.append(result[order_id]['error_message'])
+    if error_message:
+        production_logging.error(f"{datetime.now()} - error: {error_message}")
+    return result
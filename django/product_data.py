@@ -3,14 +3,114 @@ from core.views.shop.shop import Product
 from django.http import Http404
 from core.models import SEOSetting
 from core.views.seo_setting_data import SEOSettingsData
+from django.core.cache import cache
+from django.db.models import Avg, Q, prefetch_related_objects
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+import hashlib
 import logging
+import random
+import time
+
+# Cached data is invalidated by version bump in signal receivers of this module. Bump is visible to all workers
+# only with shared cache backend (Redis, memcached), receivers are connected when this module is imported, so saves
+# from processes not importing it are not seen. Finite timeout bounds staleness in these cases and expires
+# entries of old versions.
+SEO_SETTINGS_CACHE_KEY = 'product_seo_settings'
+SEO_SETTINGS_VERSION_KEY = 'product_seo_settings_version'
+SEO_SETTINGS_CACHE_TIMEOUT = 60 * 60
+CATEGORY_URLS_CACHE_KEY = 'product_category_urls'
+CATEGORY_URLS_VERSION_KEY = 'product_category_urls_version'
+CATEGORY_URLS_CACHE_TIMEOUT = 60 * 60
+SAMPLE_IDS_CACHE_TIMEOUT = 60 * 15
+FEEDBACK_RATING_FIELD = 'approved_feedback_rating'
+
+category_model = Product.main_category.field.related_model
+menu_category_field = category_model.menu_category_set.field
+menu_model = menu_category_field.model
+_category_urls = {'version': None, 'urls': {}, 'expires': 0}
+
+
+def get_cache_version(version_key):
+    """ Current version of cached data """
+    return cache.get_or_set(version_key, 1, None)
+
+
+def bump_cache_version(version_key):
+    """ Invalidate cached data by moving to the next version """
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        cache.set(version_key, 2, None)
+
+
+@receiver([post_save, post_delete], sender=SEOSetting)
+def invalidate_seo_settings(**kwargs):
+    """ Bump seo settings cache version when any setting changes """
+    bump_cache_version(SEO_SETTINGS_VERSION_KEY)
+
+
+@receiver([post_save, post_delete], sender=menu_model)
+@receiver([post_save, post_delete], sender=category_model)
+def invalidate_category_urls(**kwargs):
+    """ Bump category urls cache version when menu or category changes """
+    bump_cache_version(CATEGORY_URLS_VERSION_KEY)
+
+
+def build_category_urls():
+    """ Materialize url path of the first menu item for every category """
+    menu_items = {menu_item.pk: menu_item for menu_item in menu_model.objects.all()}
+    menu_paths = dict()
+    category_urls = dict()
+    for menu_item in menu_items.values():
+        chain = list()
+        menu_parent = menu_item
+        while menu_parent and menu_parent.pk not in menu_paths and menu_parent not in chain:
+            chain.append(menu_parent)
+            menu_parent = menu_items.get(menu_parent.parent_id)
+        result = menu_paths.get(menu_parent.pk, '/') if menu_parent else '/'
+        for chain_item in reversed(chain):
+            result = result + chain_item.get_slug() + '/'
+            menu_paths[chain_item.pk] = result
+        category_urls.setdefault(getattr(menu_item, menu_category_field.attname), menu_paths[menu_item.pk])
+    return category_urls
+
+
+def annotate_feedback_rating(queryset):
+    """ Annotate products with average rating of approved feedbacks """
+    return queryset.annotate(**{FEEDBACK_RATING_FIELD: Avg('product_feedback__rating',
+                                                           filter=Q(product_feedback__status='approved'))})
+
+
+def set_feedback_rating(products):
+    """ Set average feedback rating for products without annotation by one query """
+    missing_products = [item for item in products if not hasattr(item, FEEDBACK_RATING_FIELD)]
+    if missing_products:
+        ratings = dict(annotate_feedback_rating(Product.objects.filter(
+            id__in=[item.pk for item in missing_products])).values_list('id', FEEDBACK_RATING_FIELD))
+        for item in missing_products:
+            setattr(item, FEEDBACK_RATING_FIELD, ratings.get(item.pk))
+
+
+def get_category_urls():
+    """ Get category urls from process memory, cache or db, resolve once per batch of products """
+    version = get_cache_version(CATEGORY_URLS_VERSION_KEY)
+    if _category_urls['version'] != version or _category_urls['expires'] < time.monotonic():
+        category_urls = cache.get(CATEGORY_URLS_CACHE_KEY, version=version)
+        if category_urls is None:
+            category_urls = build_category_urls()
+            cache.set(CATEGORY_URLS_CACHE_KEY, category_urls, CATEGORY_URLS_CACHE_TIMEOUT, version=version)
+        _category_urls['version'] = version
+        _category_urls['urls'] = category_urls
+        _category_urls['expires'] = time.monotonic() + CATEGORY_URLS_CACHE_TIMEOUT
+    return _category_urls['urls']
 
 
 class ProductData:
     """Product data"""
 
     def __init__(self, product=None, slug=None, fields=None, additional_fields=None, prefetch_related=None,
-                 user_role=None):
+                 user_role=None, random_seed=None):
         self.slug = slug
         self.product_item = product
         self.prefetch_related = prefetch_related or []
@@ -19,6 +119,9 @@ class ProductData:
         self.product = self._get_product()
         self.user_role = user_role
         self.exclude_fields = ['min_price', 'max_price', 'old_min_price', 'old_max_price', 'productrole_set']
+        self._role_items = None
+        self._role_price = None
+        self.random = random.Random(random_seed)
 
     def _get_product(self):
         """ Get product from db or like item"""
@@ -33,11 +136,14 @@ class ProductData:
 
     @staticmethod
     def _get_seo_settings():
-        """ Get seo settings """
-        seo_setting_items = SEOSetting.objects.all()
-        seo_setting = {}
-        for seo_setting_item in seo_setting_items:
-            seo_setting[seo_setting_item.key_name] = seo_setting_item.value
+        """ Get seo settings from cache or db """
+        version = get_cache_version(SEO_SETTINGS_VERSION_KEY)
+        seo_setting = cache.get(SEO_SETTINGS_CACHE_KEY, version=version)
+        if seo_setting is None:
+            seo_setting = {}
+            for seo_setting_item in SEOSetting.objects.all():
+                seo_setting[seo_setting_item.key_name] = seo_setting_item.value
+            cache.set(SEO_SETTINGS_CACHE_KEY, seo_setting, SEO_SETTINGS_CACHE_TIMEOUT, version=version)
         return seo_setting
 
     def _get_meta_title(self, seo_setting):
@@ -70,53 +176,49 @@ class ProductData:
             'old_min_price': self.product.old_min_price,
             'old_max_price': self.product.old_max_price
         }
-        if self.user_role:
-            for role_item in self.product.productrole_set.all():
-                if role_item.role_id_id == self.user_role.pk:
-                    if role_item.min_price:
-                        variation_price['min_price'] = role_item.min_price
-                    if role_item.max_price:
-                        variation_price['max_price'] = role_item.max_price
-                    if role_item.old_min_price:
-                        variation_price['old_min_price'] = role_item.old_min_price
-                    if role_item.old_max_price:
-                        variation_price['old_max_price'] = role_item.old_max_price
+        role_item = self._get_user_role_item()
+        if role_item:
+            if role_item.min_price:
+                variation_price['min_price'] = role_item.min_price
+            if role_item.max_price:
+                variation_price['max_price'] = role_item.max_price
+            if role_item.old_min_price:
+                variation_price['old_min_price'] = role_item.old_min_price
+            if role_item.old_max_price:
+                variation_price['old_max_price'] = role_item.old_max_price
         return variation_price
 
-    def get_url(self):
-        """ Get product url """
-        get_category = self.product.main_category
-        if get_category:
-            get_menu = get_category.menu_category_set.all()
-            if get_menu:
-                get_menu = get_menu[0]
-                watcher = 1
-                menu_parent = get_menu
-                result = get_menu.get_slug() + '/'
-                while watcher == 1:
-                    if menu_parent.parent:
-                        parent_slug = menu_parent.parent.get_slug()
-                        result = parent_slug + '/' + result
-                        menu_parent = menu_parent.parent
-                    else:
-                        watcher = 0
-                result = '/' + result
-                return result
+    def get_url(self, category_urls=None):
+        """ Get product url, category urls are passed for batch of products """
+        if self.product.main_category_id:
+            if category_urls is None:
+                category_urls = get_category_urls()
+            return category_urls.get(self.product.main_category_id)
         return None
 
-    def _get_price_by_user_role(self, ):
-        """ Get price by role """
-        product_price = dict()
-
-        if self.user_role:
+    def _get_user_role_item(self):
+        """ Get product role item for user role """
+        if not self.user_role:
+            return None
+        if self._role_items is None:
+            self._role_items = dict()
             for role_item in self.product.productrole_set.all():
-                if role_item.role_id_id == self.user_role.pk:
-                    price = role_item.discount_price or role_item.price
-                    if price:
-                        product_price['price'] = price
-                        if role_item.discount_price:
-                            product_price['old_price'] = role_item.price
-            return product_price
+                self._role_items.setdefault(role_item.role_id_id, role_item)
+        return self._role_items.get(self.user_role.pk)
+
+    def _get_price_by_user_role(self, ):
+        """ Get price by role, calculated once per product """
+        if self._role_price is None and self.user_role:
+            product_price = dict()
+            role_item = self._get_user_role_item()
+            if role_item:
+                price = role_item.discount_price or role_item.price
+                if price:
+                    product_price['price'] = price
+                    if role_item.discount_price:
+                        product_price['old_price'] = role_item.price
+            self._role_price = product_price
+        return self._role_price
 
     def get_price(self):
         """ Get product price """
@@ -146,15 +248,12 @@ class ProductData:
 
     def average_feedback_rating(self):
         """ Average feedback rating"""
-        product_feedbacks = self.product.product_feedback.all()
-        result = 0
-        for item in product_feedbacks:
-            if item.status == 'approved':
-                result = result + item.rating
-        if result:
-            return result / len(product_feedbacks)
-
-    def generate_product_data(self):
+        if hasattr(self.product, FEEDBACK_RATING_FIELD):
+            return getattr(self.product, FEEDBACK_RATING_FIELD)
+        return self.product.product_feedback.aggregate(
+            rating=Avg('rating', filter=Q(status='approved')))['rating']
+
+    def generate_product_data(self, seo_setting=None, category_urls=None):
         """ Add additional data for product """
         product_data = self.get_product_data()
         if self.additional_fields:
@@ -163,41 +262,81 @@ class ProductData:
             if 'product_price' in self.additional_fields:
                 product_data['product_price'] = self.get_product_price()
             if 'get_url' in self.additional_fields:
-                product_data['get_url'] = self.get_url()
+                product_data['get_url'] = self.get_url(category_urls)
             if 'average_feedback_rating' in self.additional_fields:
                 product_data['average_feedback_rating'] = self.average_feedback_rating()
             if 'seo_data' in self.additional_fields:
-                seo_setting = self._get_seo_settings()
+                seo_setting = seo_setting if seo_setting is not None else self._get_seo_settings()
                 product_data['seo_title'] = self._get_meta_title(seo_setting)
                 product_data['seo_description'] = self._get_meta_description(seo_setting)
                 product_data['seo_keywords'] = self.product.seo_keywords
                 product_data['seo_nofollow'] = self.product.seo_nofollow
         return product_data
 
+    def _get_batch_prefetch_related(self):
+        """ Relations used by additional fields """
+        prefetch_related = list()
+        additional_fields = self.additional_fields or []
+        if self.user_role and ('variation_price' in additional_fields or 'product_price' in additional_fields):
+            prefetch_related.append('productrole_set')
+        return prefetch_related
+
+    def generate_products_data(self, products):
+        """ Generate product data for many products with shared prefetch and seo settings """
+        products = list(products)
+        prefetch_related_objects(products, *self._get_batch_prefetch_related())
+        if self.additional_fields and 'average_feedback_rating' in self.additional_fields:
+            set_feedback_rating(products)
+        seo_setting = None
+        if self.additional_fields and 'seo_data' in self.additional_fields:
+            seo_setting = self._get_seo_settings()
+        category_urls = None
+        if self.additional_fields and 'get_url' in self.additional_fields:
+            category_urls = get_category_urls()
+        result = list()
+        for item in products:
+            get_product_item = ProductData(product=item, fields=self.fields, additional_fields=self.additional_fields,
+                                           user_role=self.user_role)
+            result.append(get_product_item.generate_product_data(seo_setting, category_urls))
+        return result
+
     def short_data(self, queryset):
         """Short data for list products"""
+        if self.additional_fields:
+            return self.generate_products_data(queryset)
         serializer = ProductSerializer(queryset, many=True, fields=self.fields)
         return serializer.data
 
+    @staticmethod
+    def _get_category_product_ids(category_ids):
+        """ Get ordered product ids for categories, cached per category set """
+        cache_key = 'product_sample_ids_' + hashlib.md5(
+            ','.join(map(str, sorted(category_ids))).encode()).hexdigest()
+        product_ids = cache.get(cache_key)
+        if product_ids is None:
+            product_ids = list(Product.objects.filter(category__in=category_ids).order_by('id').values_list(
+                'id', flat=True).distinct())
+            cache.set(cache_key, product_ids, SAMPLE_IDS_CACHE_TIMEOUT)
+        return product_ids
+
+    def _sample_products(self, queryset, product_ids, count):
+        """ Pick random products by id without sorting the whole table """
+        product_ids = [product_id for product_id in product_ids if product_id != self.product.pk]
+        count = min(int(count), len(product_ids))
+        sample_ids = self.random.sample(product_ids, count)
+        products = {item.pk: item for item in queryset.filter(id__in=sample_ids)}
+        return [products[product_id] for product_id in sample_ids if product_id in products]
+
     def get_relations(self, count=3):
         """Get relation products"""
-        result = list()
-        get_relation_product = self.product.relation_products.all().order_by('?')[:int(count)]
-        for item in get_relation_product:
-            get_product_item = ProductData(product=item, fields=self.fields, additional_fields=self.additional_fields,
-                                           user_role=self.user_role)
-            result.append(get_product_item.generate_product_data())
-        return result
+        relation_ids = list(self.product.relation_products.order_by('id').values_list('id', flat=True))
+        get_relation_product = self._sample_products(Product.objects.all(), relation_ids, count)
+        return self.generate_products_data(get_relation_product)
 
     def get_same_products(self, count=3):
         """Get the same products"""
+        category_ids = [item.pk for item in self.product.category.all()]
         queryset = Product.objects.prefetch_related('product_variation', 'category', 'category__menu_category_set',
-                                                    'productrole_set').select_related(
-            'measurement_id').filter(category__in=self.product.category.all()).exclude(
-            slug=self.slug).all().order_by('?')[:int(count)]
-        result = list()
-        for item in queryset:
-            get_product_item = ProductData(product=item, fields=self.fields, additional_fields=self.additional_fields,
-                                           user_role=self.user_role)
-            result.append(get_product_item.generate_product_data())
-        return result
+                                                    'productrole_set').select_related('measurement_id')
+        same_products = self._sample_products(queryset, self._get_category_product_ids(category_ids), count)
+        return self.generate_products_data(same_products)
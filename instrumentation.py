@@ -0,0 +1,167 @@
+from functools import wraps
+import contextlib
+import socket
+import json
+import time
+import os
+
+
+class Timer:
+    """ Context manager adding elapsed time to metrics timer """
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        if exc_type:
+            self.metrics.incr(f"{self.name}.errors")
+        return False
+
+
+class Metrics:
+    """ Timers and counters of pipeline job, disabled unless METRICS_ENABLED is set """
+    NULL_TIMER = contextlib.nullcontext()
+
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = os.getenv('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+        self.enabled = enabled
+        self.timers = dict()
+        self.counters = dict()
+
+    def timer(self, name):
+        """ Time block of code """
+        if not self.enabled:
+            return self.NULL_TIMER
+        return Timer(self, name)
+
+    def observe(self, name, seconds):
+        """ Add timing to timer """
+        if not self.enabled:
+            return
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+        timer['count'] += 1
+        timer['total'] += seconds
+        timer['max'] = max(timer['max'], seconds)
+
+    def incr(self, name, value=1):
+        """ Increase counter """
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, report):
+        """ Add report collected in other process, e.g. worker of sharded stage """
+        if not self.enabled or not report:
+            return
+        for name, timer in report['timers'].items():
+            current = self.timers.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            current['count'] += timer['count']
+            current['total'] += timer['total']
+            current['max'] = max(current['max'], timer['max'])
+        for name, value in report['counters'].items():
+            self.incr(name, value)
+
+    def reset(self):
+        self.timers = dict()
+        self.counters = dict()
+
+    def report(self):
+        """ Collected timers and counters """
+        return {
+            'timers': {name: {'count': timer['count'], 'total': round(timer['total'], 6),
+                              'max': round(timer['max'], 6)} for name, timer in self.timers.items()},
+            'counters': dict(self.counters)
+        }
+
+    @staticmethod
+    def _metric_name(prefix, name):
+        return f"{prefix}_{name}".replace('.', '_').replace('-', '_')
+
+    def to_prometheus(self, prefix='markups', labels=None):
+        """ Report in Prometheus text exposition format """
+        label_text = ','.join(f'{key}="{value}"' for key, value in (labels or {}).items())
+        label_text = f"{{{label_text}}}" if label_text else ''
+        lines = list()
+        for name, timer in self.timers.items():
+            metric_name = self._metric_name(prefix, name)
+            lines.append(f"# TYPE {metric_name}_seconds summary")
+            lines.append(f"{metric_name}_seconds_count{label_text} {timer['count']}")
+            lines.append(f"{metric_name}_seconds_sum{label_text} {timer['total']}")
+        for name, value in self.counters.items():
+            metric_name = self._metric_name(prefix, name)
+            lines.append(f"# TYPE {metric_name}_total counter")
+            lines.append(f"{metric_name}_total{label_text} {value}")
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def prometheus_file_name(job_name, labels=None):
+        """ Textfile name unique per job and labels, so accounts of one run do not overwrite each other """
+        label_parts = [f"{key}_{value}" for key, value in sorted((labels or {}).items())]
+        file_name = '_'.join([job_name] + label_parts)
+        return ''.join(char if char.isalnum() or char in '_-' else '_' for char in file_name) + '.prom'
+
+    def write_prometheus(self, prometheus_dir, job_name, labels=None):
+        """ Write textfile atomically, collector never reads partially written file """
+        path = f"{prometheus_dir}/{self.prometheus_file_name(job_name, labels)}"
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as prometheus_file:
+            prometheus_file.write(self.to_prometheus(labels=labels))
+        os.replace(temp_path, path)
+        return path
+
+    def send_statsd(self, host, port=8125, prefix='markups'):
+        """ Send report to StatsD over UDP """
+        lines = list()
+        for name, timer in self.timers.items():
+            lines.append(f"{prefix}.{name}:{round(timer['total'] * 1000, 3)}|ms")
+        for name, value in self.counters.items():
+            lines.append(f"{prefix}.{name}:{value}|c")
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as statsd_socket:
+            for line in lines:
+                statsd_socket.sendto(line.encode(), (host, int(port)))
+
+    def flush(self, job_name, logger=None, labels=None):
+        """ Emit per-job report to log, Prometheus textfile and StatsD, then reset """
+        if not self.enabled:
+            return None
+        report = self.report()
+        if logger:
+            logger.info(f"Metrics {job_name}: {json.dumps(report)}")
+        else:
+            print(f"Metrics {job_name}: {json.dumps(report)}")
+        prometheus_dir = os.getenv('METRICS_PROMETHEUS_DIR')
+        if prometheus_dir:
+            self.write_prometheus(prometheus_dir, job_name, labels)
+        if os.getenv('STATSD_HOST'):
+            self.send_statsd(os.getenv('STATSD_HOST'), os.getenv('STATSD_PORT', 8125), prefix=f"markups.{job_name}")
+        self.reset()
+        return report
+
+
+metrics = Metrics()
+
+
+def timed(name):
+    """ Decorator timing every call of function """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return function(*args, **kwargs)
+            with Timer(metrics, name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,13 +1,11 @@
-from db.db import connect_db_data
 from set_logging import Logging
-from bucket import Bucket
-from dotenv import load_dotenv
-import pandas
-import psycopg2
-import psycopg2.extras  # type: ignore
+from bucket import Bucket, load_environment
+from instrumentation import metrics, timed
+from markup_files import iter_rows, resolve_file_name, PREPROCESSED_MARKUP_COLUMNS, PREPROCESSED_RULES_COLUMNS
+from db_queries import PreparedQueries, array_literal
+from functools import cached_property
 import sys
 import os
-load_dotenv()
 
 
 class LoadData(Bucket, Logging):
@@ -15,52 +13,91 @@ class LoadData(Bucket, Logging):
 
     def __init__(self, markup_type_for_path, account_id, markup_path='preprocessed_markup.csv',
                  rules_path='preprocessed_rules.csv'):
+        load_environment()
         Bucket.__init__(self, os.getenv('AWS_BUCKET_NAME'))
         Logging.__init__(self, '', f"load_markups_{markup_type_for_path}.log",
                               f"{__name__}_{markup_type_for_path}")
-        self.db_connect_data = connect_db_data(cursor_factory=psycopg2.extras.DictCursor)
-        self.path_to_rules = rules_path
-        self.path_to_markups = markup_path
+        self.markup_path = markup_path
+        self.rules_path = rules_path
         self.list_segments = None
         self.account_id = account_id
         self.type = markup_type_for_path
         self.models = list()
         self.archive_folder_name = 'archive_models'
         self.path_bucket_folder = f"models/{account_id}/{markup_type_for_path}"
-        self.folder_list, self.timestamp = self.load_directories(self.path_bucket_folder)
+
+    @cached_property
+    def db_connect_data(self):
+        """ DB connection, opened on first query """
+        from db.db import connect_db_data
+        import psycopg2.extras
+        return connect_db_data(cursor_factory=psycopg2.extras.DictCursor)
+
+    @cached_property
+    def queries(self):
+        """ Prepared statements of DB connection """
+        return PreparedQueries(self.db_connect_data)
+
+    @cached_property
+    def directories(self):
+        """ Timestamp folders and latest timestamp, listed from bucket once """
+        return self.load_directories(self.path_bucket_folder)
+
+    @cached_property
+    def folder_list(self):
+        return self.directories[0]
+
+    @cached_property
+    def timestamp(self):
+        return self.directories[1]
+
+    @cached_property
+    def path_to_rules(self):
+        return resolve_file_name(self.rules_path, self.folder_list.get(self.timestamp))
+
+    @cached_property
+    def path_to_markups(self):
+        return resolve_file_name(self.markup_path, self.folder_list.get(self.timestamp))
 
     def load_data(self):
         """ Load data to DB"""
         print(f"Start load markups and segments for type {self.type}")
         markups = self.get_file(f"{self.path_bucket_folder}/{self.timestamp}/{self.path_to_markups}")
         rules = self.get_file(f"{self.path_bucket_folder}/{self.timestamp}/{self.path_to_rules}")
+        result = False
         if markups and rules:
-            self.load_segments(rules)
-            self.load_markups(markups)
-            self.activation()
+            with metrics.timer('stage.load_segments'):
+                self.load_segments(rules)
+            with metrics.timer('stage.load_markups'):
+                self.load_markups(markups)
+            with metrics.timer('stage.activation'):
+                self.activation()
             self.db_connect_data.cursor.close()
-            return True
-        return False
+            result = True
+        metrics.flush(f"load_markups_{self.type}", self.logger, {'account_id': self.account_id, 'type': self.type})
+        return result
 
+    @timed('db.insert_to_db')
     def insert_to_db(self, table: str, fields: tuple, data: tuple, returning_fields: list):
         """ Insert data to DB """
+        import psycopg2.extras
         query = f""" INSERT INTO {table} ({','.join(fields)}) VALUES %s RETURNING {','.join(returning_fields)} """
         result = psycopg2.extras.execute_values(
             self.db_connect_data.cursor, query, data, fetch=True
         )
         return result[0]
 
+    @timed('db.get_from_db')
     def get_from_db(self, returning_fields: list, table: str, conditions: dict):
         """ Get from DB """
         query = f""" SELECT {','.join(returning_fields)} FROM {table} """
+        params = list()
         if conditions:
-            counter = 0
             for name, value in conditions.items():
-                query += "WHERE " if counter == 0 else "AND "
-                query += f""" {name} = '{value}'"""
-                counter += 1
-        self.db_connect_data.cursor.execute(query)
-        return self.db_connect_data.cursor.fetchone()
+                query += "WHERE " if not params else "AND "
+                params.append(str(value))
+                query += f""" {name} = ${len(params)} """
+        return self.queries.fetchone(query, params)
 
     def insert_or_get(self, returning_fields, table, conditions):
         """ Get item from db if exists or insert """
@@ -75,6 +112,7 @@ class LoadData(Bucket, Logging):
             print(e)
             self.logger.error(f"Error to get or insert: table {table}")
 
+    @timed('db.add_or_update_segment')
     def add_or_update_segment(self, data):
         """ Add data for table segments or update it if exists """
         try:
@@ -90,15 +128,15 @@ class LoadData(Bucket, Logging):
             self.logger.error(f"Error add or update segment")
             return False
 
+    @timed('db.get_list_segments')
     def get_list_segments(self, timestamp):
         """ Get list segments """
         try:
-            segment_query = f""" SELECT segments.id, models.name, segments.segment_number FROM data.segments segments 
+            segment_query = """ SELECT segments.id, models.name, segments.segment_number FROM data.segments segments 
             JOIN data.account_models account_models ON segments.account_model_id = account_models.id
             JOIN data.models models ON account_models.model_id = models.id
-            WHERE account_models.model_version = '{timestamp}'"""
-            self.db_connect_data.cursor.execute(segment_query)
-            segment_item = self.db_connect_data.cursor.fetchall()
+            WHERE account_models.model_version = $1"""
+            segment_item = self.queries.fetchall(segment_query, (str(timestamp),))
             if not segment_item:
                 self.logger.error(f"List segment not found: model_version - {timestamp}")
             return segment_item
@@ -112,6 +150,7 @@ class LoadData(Bucket, Logging):
             if segment_list_item.get('segment_number') == segment and segment_list_item.get('name') == model:
                 return segment_list_item.get('id')
 
+    @timed('db.insert_markup')
     def insert_markup(self, data):
         """ Insert markup to DB """
         try:
@@ -119,6 +158,7 @@ class LoadData(Bucket, Logging):
             VALUES {','.join(['%s'] * len(data))} """
             self.db_connect_data.cursor.execute(add_markup_query, data)
             self.db_connect_data.connection.commit()
+            metrics.incr('markups.inserted', len(data))
         except Exception as e:
             print(e)
             self.logger.error('Error getting segments list')
@@ -133,7 +173,7 @@ class LoadData(Bucket, Logging):
         account_models = {}
         segments_data = []
 
-        for index, item in pandas.read_csv(rules, delimiter=",").iterrows():
+        for index, item in iter_rows(rules, self.path_to_rules, PREPROCESSED_RULES_COLUMNS):
             if not model_temp or model_temp[1] != item.get('model'):
                 model_item = self.insert_or_get(['id'], 'data.models', {"name": item.get('model')})
                 if model_item:
@@ -161,6 +201,8 @@ class LoadData(Bucket, Logging):
         segment_item = self.add_or_update_segment(segments_data)
         if segment_item:
             self.db_connect_data.connection.commit()
+        metrics.incr('segments.success', success_point)
+        metrics.incr('segments.error', error_point)
         self.logger.info(f"Status adding segments: success - {success_point}, error - {error_point} ")
 
     def load_markups(self, markups):
@@ -171,7 +213,8 @@ class LoadData(Bucket, Logging):
         error_point = 0
         counter = 0
         data = list()
-        for markup_index, markup_item in pandas.read_csv(markups, delimiter=",").iterrows():
+        for markup_index, markup_item in iter_rows(markups, self.path_to_markups,
+                                                           PREPROCESSED_MARKUP_COLUMNS):
             if not self.list_segments:
                 list_segment = self.get_list_segments(self.timestamp)
                 if list_segment:
@@ -201,6 +244,8 @@ class LoadData(Bucket, Logging):
             success_point += 1
         else:
             self.insert_markup(data)
+        metrics.incr('markups.success', success_point)
+        metrics.incr('markups.error', error_point)
         self.logger.info(f"Status adding markups: success - {success_point}, error - {error_point} ")
 
     def activation(self):
@@ -212,9 +257,9 @@ class LoadData(Bucket, Logging):
     def archiving_markups(self, account_models_for_delete, timestamp_folders_for_delete):
         """ Archiving old markups """
         if account_models_for_delete:
-            query = f""" SELECT DISTINCT (model_version) FROM data.account_models WHERE id NOT IN ({','.join(account_models_for_delete)}) AND model_version IN ({','.join(map(lambda x: f"'{x}'", timestamp_folders_for_delete))})"""
-            self.db_connect_data.cursor.execute(query)
-            result = self.db_connect_data.cursor.fetchall()
+            query = """ SELECT DISTINCT (model_version) FROM data.account_models WHERE id <> ALL($1) AND model_version = ANY($2)"""
+            result = self.queries.fetchall(query, (array_literal(account_models_for_delete),
+                                                   array_literal(timestamp_folders_for_delete)))
             for item in timestamp_folders_for_delete:
                 if [item] not in result:
                     folder_objects = self.get_list_objects_folder(f"{self.path_bucket_folder}/{item}/")
@@ -230,9 +275,8 @@ class LoadData(Bucket, Logging):
         models that need to activate  """
         result = list()
         if self.models:
-            query = f""" SELECT * FROM  data.account_models WHERE account_id = '{self.account_id}' AND model_id in ({','.join(self.models)}) ORDER BY model_version DESC """
-            self.db_connect_data.cursor.execute(query)
-            result = self.db_connect_data.cursor.fetchall()
+            query = """ SELECT * FROM  data.account_models WHERE account_id = $1 AND model_id = ANY($2) ORDER BY model_version DESC """
+            result = self.queries.fetchall(query, (str(self.account_id), array_literal(self.models)))
         unique_models = list()
         model_counter = dict()
         account_models_for_activation = list()
@@ -262,8 +306,9 @@ class LoadData(Bucket, Logging):
     def activate_account_models(self, account_models_for_activation):
         """ Activate new models and deactivate previous models"""
         if account_models_for_activation:
-            query_delete_old_active_account_models = f""" DELETE FROM data.active_account_models WHERE account_id = '{self.account_id}' AND model_id IN ({','.join(self.models)})"""
-            self.db_connect_data.cursor.execute(query_delete_old_active_account_models)
+            query_delete_old_active_account_models = """ DELETE FROM data.active_account_models WHERE account_id = $1 AND model_id = ANY($2)"""
+            self.queries.execute(query_delete_old_active_account_models,
+                                 (str(self.account_id), array_literal(self.models)))
             query_activate_account_models = f""" INSERT INTO data.active_account_models (account_id, model_id, account_model_id) VALUES  {','.join(['%s'] * len(account_models_for_activation))}"""
             self.db_connect_data.cursor.execute(query_activate_account_models, account_models_for_activation)
             self.db_connect_data.connection.commit()
@@ -0,0 +1,150 @@
+import heapq
+import pickle
+import tempfile
+import math
+import os
+
+
+def read_pickle_batches(path):
+    """ Iterate batches appended to file by pickle.dump """
+    with open(path, 'rb') as batches_file:
+        while True:
+            try:
+                yield pickle.load(batches_file)
+            except EOFError:
+                return
+
+
+class MarkupDeduplicator:
+    """ Keep one markup row per key by policy: first, last or highest predicted value, none keeps every row
+
+    Rows are kept in memory up to chunk_size keys, then spilled to partition files on disk by key hash.
+    Partition with more than chunk_size records is split again by salted key hash, so each partition is
+    deduplicated in memory of chunk_size records. Sorted partitions are merged in original order of rows,
+    merge keeps MERGE_BATCH_SIZE records per partition in memory.
+    """
+    POLICIES = ('first', 'last', 'highest', 'none')
+    MERGE_BATCH_SIZE = 1000
+    # split does not reduce partition made of few keys repeated in more than chunk_size spills,
+    # such partition is deduplicated in memory after this level
+    MAX_SPLIT_LEVEL = 8
+
+    def __init__(self, policy='first', chunk_size=1000000, partitions=16, temp_dir=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown deduplication policy: {policy}, expected one of {self.POLICIES}")
+        self.policy = policy
+        self.chunk_size = chunk_size
+        self.partitions = partitions
+        self.temp_dir = temp_dir
+        self.items = dict()
+        self.sequence = 0
+        self.output_rows = 0
+        self.spill_dir = None
+        self.partition_sizes = dict()
+
+    @property
+    def duplicates(self):
+        """ Number of dropped rows, known after all rows are iterated """
+        return self.sequence - self.output_rows
+
+    @staticmethod
+    def _rank(rank):
+        if rank is None or rank != rank:
+            return float('-inf')
+        return rank
+
+    def _is_better(self, candidate, current):
+        """ Compare records (sequence, rank, row) by policy """
+        if self.policy == 'first':
+            return candidate[0] < current[0]
+        if self.policy == 'last':
+            return candidate[0] > current[0]
+        return (self._rank(candidate[1]), -candidate[0]) > (self._rank(current[1]), -current[0])
+
+    def _reduce(self, items, records):
+        for key, record in records:
+            current = items.get(key)
+            if current is None or self._is_better(record, current):
+                items[key] = record
+
+    def add(self, key, rank, row):
+        """ Add row with deduplication key and predicted value """
+        if self.policy == 'none':
+            key = self.sequence
+        record = (self.sequence, rank, row)
+        current = self.items.get(key)
+        if current is None or self._is_better(record, current):
+            self.items[key] = record
+        self.sequence += 1
+        if len(self.items) >= self.chunk_size:
+            self._spill()
+
+    def _partition_path(self, partition, kind='spill'):
+        return f"{self.spill_dir.name}/{kind}_{partition}.pickle"
+
+    def _write_partitions(self, records, partition_count, partition_name, salt=None):
+        """ Append records to partition files by key hash """
+        partitions = [list() for _ in range(partition_count)]
+        for key, record in records:
+            partitions[hash((salt, key) if salt is not None else key) % partition_count].append((key, record))
+        for number, partition_records in enumerate(partitions):
+            if partition_records:
+                partition = partition_name(number)
+                with open(self._partition_path(partition), 'ab') as partition_file:
+                    pickle.dump(partition_records, partition_file)
+                self.partition_sizes[partition] = self.partition_sizes.get(partition, 0) + len(partition_records)
+
+    def _spill(self):
+        """ Move kept records to partition files """
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.TemporaryDirectory(dir=self.temp_dir)
+        self._write_partitions(self.items.items(), self.partitions, str)
+        self.items = dict()
+
+    def _sorted_partitions(self, partition, level=0):
+        """ Deduplicate partition to files sorted by sequence, partition above chunk_size is split first """
+        path = self._partition_path(partition)
+        size = self.partition_sizes.pop(partition)
+        if size > self.chunk_size and level < self.MAX_SPLIT_LEVEL:
+            partition_count = 2 * math.ceil(size / self.chunk_size)
+            for records in read_pickle_batches(path):
+                self._write_partitions(records, partition_count, lambda number: f"{partition}_{number}", level)
+            os.remove(path)
+            paths = list()
+            for number in range(partition_count):
+                if f"{partition}_{number}" in self.partition_sizes:
+                    paths.extend(self._sorted_partitions(f"{partition}_{number}", level + 1))
+            return paths
+        items = dict()
+        for records in read_pickle_batches(path):
+            self._reduce(items, records)
+        os.remove(path)
+        records = sorted(items.values(), key=lambda record: record[0])
+        path = self._partition_path(partition, 'sorted')
+        with open(path, 'wb') as partition_file:
+            for start in range(0, len(records), self.MERGE_BATCH_SIZE):
+                pickle.dump(records[start:start + self.MERGE_BATCH_SIZE], partition_file)
+        return [path]
+
+    @staticmethod
+    def _iter_sorted(path):
+        for records in read_pickle_batches(path):
+            yield from records
+
+    def __iter__(self):
+        """ Deduplicated rows in original order """
+        self.output_rows = 0
+        if self.spill_dir is None:
+            records = sorted(self.items.values(), key=lambda record: record[0])
+        else:
+            self._spill()
+            paths = list()
+            for partition in sorted(self.partition_sizes):
+                paths.extend(self._sorted_partitions(partition))
+            records = heapq.merge(*[self._iter_sorted(path) for path in paths], key=lambda record: record[0])
+        for record in records:
+            self.output_rows += 1
+            yield record[2]
+        if self.spill_dir is not None:
+            self.spill_dir.cleanup()
+            self.spill_dir = None
@@ -0,0 +1,290 @@
+import importlib.util
+import tempfile
+import shutil
+import io
+import os
+
+COLUMN_DTYPES = {
+    'customer_profile_id': str,
+    'eshop_customer_id': str,
+    'guest_id': str,
+    'model': 'category',
+    'segment': 'category',
+    'predicted_value': 'float64',
+    'description': 'category',
+}
+ID_COLUMNS = tuple(column for column, dtype in COLUMN_DTYPES.items() if dtype is str)
+NUMERIC_CATEGORIES = ('segment',)
+
+SEGMENT_COLUMNS = ['model', 'segment', 'predicted_value']
+MARKUP_COLUMNS = {
+    'crm': ['eshop_customer_id', 'model', 'segment', 'predicted_value'],
+    'beh': ['guest_id', 'model', 'segment', 'predicted_value'],
+}
+RULES_COLUMNS = ['model', 'segment', 'description']
+PREPROCESSED_MARKUP_COLUMNS = ['customer_profile_id', 'eshop_customer_id', 'model', 'segment']
+PREPROCESSED_RULES_COLUMNS = ['predicted_value', 'description', 'model', 'segment']
+
+FILE_EXTENSIONS = ('.parquet', '.csv')
+PARQUET_BATCH_SIZE = 100000
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+
+CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
+
+
+def is_parquet(file_name):
+    return file_name.endswith('.parquet')
+
+
+def resolve_file_name(file_name, folder_files):
+    """ Get name of stored file, trying other supported formats when file is not found """
+    if not folder_files or file_name in folder_files:
+        return file_name
+    base_name = os.path.splitext(file_name)[0]
+    for extension in FILE_EXTENSIONS:
+        if f"{base_name}{extension}" in folder_files:
+            return f"{base_name}{extension}"
+    return file_name
+
+
+def _id_strings(values):
+    """ Ids as str without float suffix, missing ids as None """
+    import pandas
+    if pandas.api.types.is_float_dtype(values):
+        values = values.astype('Int64')
+    return values.astype(str).astype(object).where(values.notna(), None)
+
+
+def _numeric_category(values, numeric=None):
+    """ Category with numeric categories when numeric, when numeric is None it is decided by values """
+    import pandas
+    categories = values.cat.categories
+    if numeric is False or pandas.api.types.is_numeric_dtype(categories):
+        return values
+    numeric_categories = pandas.to_numeric(categories, errors='coerce')
+    if numeric_categories.isna().any():
+        return values
+    return values.cat.rename_categories(numeric_categories)
+
+
+def _apply_schema(frame, columns, numeric_categories=None):
+    """ Cast columns to declared dtypes """
+    frame = frame.astype({column: COLUMN_DTYPES[column] for column in columns
+                          if column in frame.columns and column not in ID_COLUMNS})
+    for column in ID_COLUMNS:
+        if column in frame.columns:
+            frame[column] = _id_strings(frame[column])
+    for column in NUMERIC_CATEGORIES:
+        if column in frame.columns:
+            frame[column] = _numeric_category(frame[column], (numeric_categories or {}).get(column))
+    return frame
+
+
+def _seekable(source):
+    """ Parquet needs random access, S3 body stream is copied by chunks to spooled temp file """
+    if hasattr(source, 'read') and not (hasattr(source, 'seekable') and source.seekable()):
+        spooled_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        shutil.copyfileobj(source, spooled_file, COPY_CHUNK_SIZE)
+        spooled_file.seek(0)
+        return spooled_file
+    return source
+
+
+def _values_numeric(values):
+    """ All not missing values can be converted to numbers """
+    import pandas
+    values = pandas.Series([value for value in values if value is not None and value == value], dtype=object)
+    return not pandas.to_numeric(values, errors='coerce').isna().any()
+
+
+def _parquet_numeric_categories(parquet_file, columns):
+    """ Decide once per file if category columns are numeric, so every batch gets the same segment type """
+    import pyarrow
+    numeric_categories = dict()
+    for column in NUMERIC_CATEGORIES:
+        if column not in columns:
+            continue
+        field_type = parquet_file.schema_arrow.field(column).type
+        if pyarrow.types.is_dictionary(field_type):
+            field_type = field_type.value_type
+        if pyarrow.types.is_integer(field_type) or pyarrow.types.is_floating(field_type):
+            numeric_categories[column] = True
+            continue
+        values = set()
+        for batch in parquet_file.iter_batches(columns=[column]):
+            values.update(batch.column(0).unique().to_pylist())
+        numeric_categories[column] = _values_numeric(values)
+    return numeric_categories
+
+
+def _read_csv_pyarrow(source, columns, numeric_categories=None):
+    """ Read csv by pyarrow with id and category columns typed as strings at parse time """
+    import pyarrow
+    import pyarrow.csv
+    convert_options = pyarrow.csv.ConvertOptions(
+        include_columns=columns, strings_can_be_null=True,
+        column_types={column: pyarrow.string() for column in columns
+                      if column in ID_COLUMNS or column in NUMERIC_CATEGORIES})
+    frame = pyarrow.csv.read_csv(source, convert_options=convert_options).to_pandas()
+    return _apply_schema(frame, columns, numeric_categories)
+
+
+def read_csv(source, columns, engine=None, numeric_categories=None):
+    """ Read only needed columns of markup file with declared dtypes """
+    import pandas
+    if (engine or CSV_ENGINE) == 'pyarrow':
+        return _read_csv_pyarrow(source, columns, numeric_categories)
+    frame = pandas.read_csv(source, delimiter=",", usecols=columns,
+                            dtype={column: COLUMN_DTYPES[column] for column in columns}, engine='c')
+    return _apply_schema(frame, [column for column in columns if column in ID_COLUMNS], numeric_categories)
+
+
+def iter_tables(source, file_name, columns, batch_size=PARQUET_BATCH_SIZE):
+    """ Iterate file by parquet row groups batches, csv file is read at once """
+    if is_parquet(file_name):
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(_seekable(source))
+        numeric_categories = _parquet_numeric_categories(parquet_file, columns)
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            yield _apply_schema(batch.to_pandas(), columns, numeric_categories)
+    else:
+        yield read_csv(source, columns)
+
+
+def iter_rows(source, file_name, columns, batch_size=PARQUET_BATCH_SIZE):
+    """ Iterate rows of csv or parquet file """
+    for frame in iter_tables(source, file_name, columns, batch_size):
+        yield from frame.iterrows()
+
+
+def save_local(source, path):
+    """ Local file of markup: file path is used as is, stream is copied to path by chunks """
+    if isinstance(source, (str, os.PathLike)):
+        return source
+    with open(path, 'wb') as local_file:
+        shutil.copyfileobj(source, local_file, COPY_CHUNK_SIZE)
+    return path
+
+
+def count_rows(path, file_name):
+    """ Number of data rows of local csv or parquet file """
+    if is_parquet(file_name):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetFile(path).metadata.num_rows
+    with open(path, 'rb') as csv_file:
+        csv_file.readline()
+        return sum(1 for line in csv_file if line.strip())
+
+
+def split_file(path, file_name, part_rows):
+    """ Split local file to parts of about part_rows rows: parquet by row groups, csv by byte ranges of lines
+
+    Csv values must not contain line breaks, which holds for markup files.
+    """
+    parts = list()
+    if is_parquet(file_name):
+        import pyarrow.parquet
+        metadata = pyarrow.parquet.ParquetFile(path).metadata
+        row_groups = list()
+        rows = 0
+        for row_group in range(metadata.num_row_groups):
+            row_groups.append(row_group)
+            rows += metadata.row_group(row_group).num_rows
+            if rows >= part_rows:
+                parts.append({'row_groups': row_groups, 'rows': rows})
+                row_groups = list()
+                rows = 0
+        if row_groups:
+            parts.append({'row_groups': row_groups, 'rows': rows})
+        return parts
+    with open(path, 'rb') as csv_file:
+        offset = len(csv_file.readline())
+        start = offset
+        rows = 0
+        for line in csv_file:
+            offset += len(line)
+            if line.strip():
+                rows += 1
+            if rows == part_rows:
+                parts.append({'start': start, 'end': offset, 'rows': rows})
+                start = offset
+                rows = 0
+        if rows:
+            parts.append({'start': start, 'end': offset, 'rows': rows})
+    return parts
+
+
+def file_numeric_categories(path, file_name, columns):
+    """ Numeric category columns of local file, decided once for all parts of file """
+    if is_parquet(file_name):
+        import pyarrow.parquet
+        return _parquet_numeric_categories(pyarrow.parquet.ParquetFile(path), columns)
+    import pandas
+    numeric_categories = dict()
+    for column in NUMERIC_CATEGORIES:
+        if column in columns:
+            values = set()
+            for frame in pandas.read_csv(path, usecols=[column], dtype=str, chunksize=PARQUET_BATCH_SIZE):
+                values.update(frame[column].unique())
+            numeric_categories[column] = _values_numeric(values)
+    return numeric_categories
+
+
+def iter_part_rows(path, file_name, columns, part, numeric_categories=None, batch_size=PARQUET_BATCH_SIZE):
+    """ Iterate rows of one part of local file made by split_file """
+    if is_parquet(file_name):
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=part['row_groups'],
+                                               columns=columns):
+            yield from _apply_schema(batch.to_pandas(), columns, numeric_categories).iterrows()
+        return
+    with open(path, 'rb') as csv_file:
+        header = csv_file.readline()
+        csv_file.seek(part['start'])
+        content = csv_file.read(part['end'] - part['start'])
+    yield from read_csv(io.BytesIO(header + content), columns, numeric_categories=numeric_categories).iterrows()
+
+
+def _iter_frames(rows, columns, batch_size):
+    """ Frames of rows by batch_size with row numbers of whole file as index """
+    import pandas
+    batch = list()
+    offset = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield pandas.DataFrame(batch, columns=columns, index=range(offset, offset + len(batch)))
+            offset += len(batch)
+            batch = list()
+    if batch or not offset:
+        yield pandas.DataFrame(batch, columns=columns, index=range(offset, offset + len(batch)))
+
+
+def write_rows(rows, columns, path, batch_size=PARQUET_BATCH_SIZE):
+    """ Write rows to csv or parquet file by batches, file is the same as by write_table of all rows """
+    if is_parquet(path):
+        import pyarrow
+        import pyarrow.parquet
+        writer = None
+        for frame in _iter_frames(rows, columns, batch_size):
+            table = pyarrow.Table.from_pandas(frame, schema=writer.schema if writer else None, preserve_index=False)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+        writer.close()
+    else:
+        for number, frame in enumerate(_iter_frames(rows, columns, batch_size)):
+            frame.to_csv(path, mode='a' if number else 'w', header=not number)
+
+
+def write_table(data, path):
+    """ Write data to csv or parquet file by extension of path """
+    import pandas
+    frame = pandas.DataFrame(data)
+    if is_parquet(path):
+        frame.to_parquet(path, index=False)
+    else:
+        frame.to_csv(path)
+
@@ -0,0 +1,59 @@
+import gzip
+import json
+import time
+
+
+class NegativeLookupCache:
+    """ Customer ids without customer profile, saved with max profile id and creation time
+
+    Ids of profiles added after saved max profile id are removed after load by caller, changes of existing
+    profiles are picked up when cache is dropped after max_age_days.
+    """
+
+    def __init__(self, bucket, path, max_profile_id, max_age_days=7):
+        self.bucket = bucket
+        self.path = path
+        self.max_profile_id = max_profile_id or 0
+        self.max_age_days = max_age_days
+        self.created_at = time.time()
+        self.loaded_max_profile_id = None
+        self.ids = set()
+
+    def __contains__(self, customer_id):
+        return customer_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self):
+        """ Load ids from bucket, cache older than max age or saved for larger max profile id is dropped """
+        body = self.bucket.get_file(self.path)
+        if body:
+            cache_data = json.loads(gzip.decompress(body.read()))
+            created_at = cache_data.get('created_at') or 0
+            max_profile_id = cache_data.get('max_profile_id')
+            if created_at < time.time() - self.max_age_days * 24 * 60 * 60:
+                print(f"Negative cache expired: {self.path}, older than {self.max_age_days} days")
+            elif max_profile_id is None or max_profile_id > self.max_profile_id:
+                print(f"Negative cache invalidated: {self.path}, max profile id {max_profile_id} "
+                      f"-> {self.max_profile_id}")
+            else:
+                self.ids = set(cache_data.get('ids', []))
+                self.created_at = created_at
+                self.loaded_max_profile_id = max_profile_id
+        return self
+
+    def update(self, customer_ids):
+        self.ids.update(customer_ids)
+
+    def discard(self, customer_ids):
+        """ Remove ids which got customer profile """
+        self.ids.difference_update(customer_ids)
+
+    def save(self, temp_dir):
+        """ Save sorted ids with max profile id and creation time to bucket """
+        local_path = f"{temp_dir}/{self.path.split('/')[-1]}"
+        cache_data = {'max_profile_id': self.max_profile_id, 'created_at': self.created_at, 'ids': sorted(self.ids)}
+        with gzip.open(local_path, 'wt') as cache_file:
+            json.dump(cache_data, cache_file, separators=(',', ':'))
+        self.bucket.add_file(local_path, self.path)
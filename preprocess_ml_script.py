@@ -1,16 +1,36 @@
-from db.db import connect_db_data
+""" Preprocessing of ML markup and rules before loading to DB
+
+Configuration by environment:
+    PREPROCESS_WORKERS - worker processes for markup sharding, default 1
+    MARKUP_DEDUP_POLICY - first (default), last, highest or none. Dedup is on by default: one markup row per
+        customer profile and model is written to preprocessed markup, so LoadData inserts one row per pair to
+        data.markups. Set none to keep every row as before dedup was added.
+    NEGATIVE_CACHE_MAX_AGE_DAYS - age after which cache of customer ids without profile is dropped, default 7
+    METRICS_ENABLED, METRICS_PROMETHEUS_DIR, STATSD_HOST, STATSD_PORT - job metrics, see instrumentation.py
+"""
 from set_logging import Logging
-from dotenv import load_dotenv
-from bucket import Bucket
-import psycopg2.extras
-import pandas
-import requests
+from bucket import Bucket, load_environment
+from instrumentation import metrics, timed
+from markup_files import iter_rows, iter_part_rows, resolve_file_name, write_table, write_rows, save_local, \
+    count_rows, split_file, file_numeric_categories, MARKUP_COLUMNS, RULES_COLUMNS, SEGMENT_COLUMNS
+from negative_cache import NegativeLookupCache
+from db_queries import PreparedQueries, array_literal
+from markup_dedup import MarkupDeduplicator, read_pickle_batches
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property
 import json
+import pickle
 import tempfile
+import math
 import sys
 import os
 
-load_dotenv()
+
+def connect_db():
+    """ Connect to DB with dict cursor, DB driver is imported on first connection """
+    from db.db import connect_db_data
+    import psycopg2.extras
+    return connect_db_data(cursor_factory=psycopg2.extras.DictCursor)
 
 
 class PreprocessML(Bucket, Logging):
@@ -22,35 +42,114 @@ class PreprocessML(Bucket, Logging):
         3: 'Magento',
         4: 'Opencart3'
     }
+    SEARCH_NAMES = {'crm': 'eshop_customer_id', 'beh': 'guest_id'}
+    CHUNK_SIZES = {'crm': 1000, 'beh': 500}
+    MARKUP_ITEMS_FIELDS = ('customer_profile_id', 'model', 'segment', 'eshop_customer_id')
+    ERROR_LOGS_FIELDS = ('id', 'account_id', 'eshop_id', 'model', 'segment')
+    SEARCH_QUERIES = {
+        'crm': """SELECT customer_profile_id, eshop_customer_id FROM data.customer_profile_crm
+        WHERE eshop_customer_id = ANY($1) AND eshop_id = $2""",
+        'beh': """SELECT customer_profile_id, guest_id FROM data.customer_profile_behaviour
+        WHERE guest_id = ANY($1) AND account_id = $2""",
+    }
+    PROFILE_MAX_ID_QUERIES = {
+        'crm': """SELECT max(customer_profile_id) FROM data.customer_profile_crm WHERE eshop_id = %s""",
+        'beh': """SELECT max(customer_profile_id) FROM data.customer_profile_behaviour WHERE account_id = %s""",
+    }
+    NEW_PROFILES_QUERIES = {
+        'crm': """SELECT eshop_customer_id FROM data.customer_profile_crm
+        WHERE eshop_id = %s AND customer_profile_id > %s""",
+        'beh': """SELECT guest_id FROM data.customer_profile_behaviour
+        WHERE account_id = %s AND customer_profile_id > %s""",
+    }
 
     def __init__(self, markup_type, account_id, markup_name='markup.csv',
-                 rules_name='rules.csv'):
+                 rules_name='rules.csv', workers=None, use_negative_cache=True, dedup_policy=None,
+                 dedup_chunk_size=1000000):
+        load_environment()
         Bucket.__init__(self, os.getenv('AWS_BUCKET_NAME'))
-        self.temp_dir = tempfile.TemporaryDirectory()
-        self.markup_file_name = markup_name
-        self.rules_file_name = rules_name
+        self.workers = workers or int(os.getenv('PREPROCESS_WORKERS', 1))
+        self.markup_name = markup_name
+        self.rules_name = rules_name
         self.prefix_for_preprocessed_file = 'preprocessed'
         self.type = markup_type
         self.auth_api_token = os.getenv('AUTH_API_TOKEN')
         self.auth_api_url = os.getenv('AUTH_API_URL')
         self.account_id = account_id
-        eshop_data = self._get_eshop_data(account_id)
-        self.eshop_id = eshop_data.get('id') if eshop_data else 803
-        self.eshop_data = eshop_data
-        self.eshop_prefix = self.select_prefix(markup_type)
         self.segments = dict()
         self.path_bucket_folder = f"models/{account_id}/{markup_type}"
-        self.folder_list, self.timestamp = self.load_directories(self.path_bucket_folder)
+        self.use_negative_cache = use_negative_cache
+        self.negative_cache = None
+        self.dedup_policy = dedup_policy or os.getenv('MARKUP_DEDUP_POLICY', 'first')
+        if self.dedup_policy not in MarkupDeduplicator.POLICIES:
+            raise ValueError(f"Unknown markup dedup policy: {self.dedup_policy}, "
+                             f"expected one of {MarkupDeduplicator.POLICIES}")
+        self.dedup_chunk_size = dedup_chunk_size
+        self.markup_deduplicator = None
+        self.markup_spool_path = None
+
+    @cached_property
+    def temp_dir(self):
+        return tempfile.TemporaryDirectory()
+
+    @cached_property
+    def eshop_data(self):
+        return self._get_eshop_data(self.account_id)
+
+    @cached_property
+    def eshop_id(self):
+        return self.eshop_data.get('id') if self.eshop_data else 803
+
+    @cached_property
+    def eshop_prefix(self):
+        return self.select_prefix(self.type)
+
+    @cached_property
+    def directories(self):
+        """ Timestamp folders and latest timestamp, listed from bucket once """
+        return self.load_directories(self.path_bucket_folder)
+
+    @cached_property
+    def folder_list(self):
+        return self.directories[0]
+
+    @cached_property
+    def timestamp(self):
+        return self.directories[1]
+
+    @cached_property
+    def markup_file_name(self):
+        return resolve_file_name(self.markup_name, self.folder_list.get(self.timestamp))
+
+    @cached_property
+    def rules_file_name(self):
+        return resolve_file_name(self.rules_name, self.folder_list.get(self.timestamp))
+
+    def has_new_work(self):
+        """ Check by one bucket listing that latest timestamp folder has markup and rules to preprocess """
+        folder_files = self.folder_list.get(self.timestamp) or []
+        return self.markup_file_name in folder_files and self.rules_file_name in folder_files
 
     def start_preprocessing(self):
         """ Start preprocessing """
         print(f"Start preprocess scripts for type {self.type}")
+        if not self.has_new_work():
+            print(f"No new markup for preprocessing: {self.path_bucket_folder}/{self.timestamp}")
+            return False
+        result = self._run_preprocessing()
+        metrics.flush(f"preprocess_{self.type}", labels={'account_id': self.account_id, 'type': self.type})
+        return result
+
+    def _run_preprocessing(self):
+        """ Preprocess markup and rules of latest timestamp folder """
         markup = self.get_file(f"{self.path_bucket_folder}/{self.timestamp}/{self.markup_file_name}")
         rules = self.get_file(f"{self.path_bucket_folder}/{self.timestamp}/{self.rules_file_name}")
         if self.eshop_id and markup and rules:
-            markup_status = self.generate_new_markup(markup)
+            with metrics.timer('stage.generate_new_markup'):
+                markup_status = self.generate_new_markup(markup)
             if markup_status:
-                self.generate_new_rules(rules)
+                with metrics.timer('stage.generate_new_rules'):
+                    self.generate_new_rules(rules)
                 self.temp_dir.cleanup()
                 return True
             else:
@@ -74,60 +173,40 @@ class PreprocessML(Bucket, Logging):
                 prefix = 'customer-'
         return prefix
 
-    def generate_new_markup(self, markup):
+    def generate_new_markup(self, markup, workers=None):
         """ Generate new markup """
         print(f"Start generate new markup for type {self.type}")
-        db_connect_data = connect_db_data(cursor_factory=psycopg2.extras.DictCursor)
-        success_markup_counter = 0
-        error_markup_counter = 0
-        counter = 0
-        markup_counter = 0
-        data = list()
-        row_data = list()
-        search_name = ''
-        chunk = 1000
-        markup_items = {'customer_profile_id': [], 'model': [], 'segment': [], 'eshop_customer_id': []}
-        error_logs = {'id': [], 'account_id': [], 'eshop_id': [], 'model': [], 'segment': []}
-
-        for index, row in pandas.read_csv(markup, delimiter=",").iterrows():
-
-            markup_counter += 1
-
-            self.collect_segments(row.get('segment'), row.get('model'), row.get('predicted_value'))
-
-            if self.type == 'crm':
-                search_name = 'eshop_customer_id'
-                data.append(f"""'{self.eshop_prefix}{row.get('eshop_customer_id')}'""")
-            elif self.type == 'beh':
-                chunk = 500
-                search_name = 'guest_id'
-                data.append(f"""'{row.get('guest_id')}'""")
-            else:
-                continue
-
-            row_data.append(row)
-            counter += 1
-
-            if counter == chunk:
-                counter = 0
-                get_result = self._search_customer_profile_id(db_connect_data, data, row_data, search_name,
-                                                              error_logs, markup_items)
-                success_markup_counter += get_result['success']
-                error_markup_counter += get_result['error']
-                row_data = list()
-                data = list()
+        workers = workers or self.workers
+        columns = MARKUP_COLUMNS.get(self.type, SEGMENT_COLUMNS)
+        if self.use_negative_cache and self.type in self.SEARCH_NAMES:
+            self.negative_cache = self._load_negative_cache()
+        self.markup_deduplicator = MarkupDeduplicator(self.dedup_policy, self.dedup_chunk_size,
+                                                      temp_dir=self.temp_dir.name)
+        if workers > 1 and self.type in self.CHUNK_SIZES:
+            result = self._preprocess_markup_sharded(markup, columns, workers)
         else:
-            if self.type in ['crm', 'beh']:
-                get_result = self._search_customer_profile_id(db_connect_data, data, row_data, search_name,
-                                                              error_logs, markup_items)
-                success_markup_counter += get_result['success']
-                error_markup_counter += get_result['error']
-
-        db_connect_data.cursor.close()
+            db_connect_data = connect_db()
+            result = self._preprocess_markup_rows(db_connect_data, iter_rows(markup, self.markup_file_name, columns))
+            db_connect_data.cursor.close()
+        success_markup_counter = result['success']
+        error_markup_counter = result['error']
+        markup_counter = result['rows']
+        error_logs = result['error_logs']
+        if self.negative_cache is not None:
+            self.negative_cache.update(error_logs['id'])
+            self.negative_cache.save(self.temp_dir.name)
+        if success_markup_counter and self.type != 'mixed':
+            self.save_rows_in_temp(self.markup_deduplicator, self.MARKUP_ITEMS_FIELDS,
+                                   f"{self.prefix_for_preprocessed_file}_{self.markup_file_name}")
+            success_markup_counter = self.markup_deduplicator.output_rows
+            metrics.incr('markup.duplicates', self.markup_deduplicator.duplicates)
+            print(f"Markup duplicates removed by policy {self.dedup_policy} - {self.markup_deduplicator.duplicates}")
+        metrics.incr('markup.rows', markup_counter)
+        metrics.incr('markup.success', success_markup_counter)
+        metrics.incr('markup.error', error_markup_counter)
         print(f"Status adding markups: success - {success_markup_counter}, error - {error_markup_counter}")
         if success_markup_counter:
             if self.type != 'mixed':
-                self.save_file_in_temp(markup_items, f"{self.prefix_for_preprocessed_file}_{self.markup_file_name}")
                 self.save_file_in_temp(error_logs, f"{self.prefix_for_preprocessed_file}_markup_errors.csv")
                 old_markup_path = f"{self.path_bucket_folder}/{self.timestamp}/{self.markup_file_name}"
                 new_markup_path = f"{self.path_bucket_folder}/{self.timestamp}/preprocessed/{self.markup_file_name}"
@@ -138,6 +217,138 @@ class PreprocessML(Bucket, Logging):
             print("No matching customers with markups")
             return False
 
+    def _collect_markup_items(self, markup_items):
+        """ Move markup items of searched chunk to deduplicator or to spool file of worker
+
+        Only one chunk of markup items is kept in memory, without deduplicator and spool file items stay in lists.
+        """
+        if self.markup_deduplicator is None and not self.markup_spool_path:
+            return
+        rows = list(zip(*(markup_items[field] for field in self.MARKUP_ITEMS_FIELDS)))
+        for items in markup_items.values():
+            items.clear()
+        if self.markup_spool_path:
+            with open(self.markup_spool_path, 'ab') as spool_file:
+                pickle.dump(rows, spool_file)
+        else:
+            self._deduplicate_rows(rows)
+
+    def _deduplicate_rows(self, rows):
+        """ Add markup rows to deduplicator, key is customer profile and model """
+        for row in rows:
+            row_item = dict(zip(self.MARKUP_ITEMS_FIELDS, row))
+            model = row_item.get('model')
+            predicted_value = self.segments.get(model, dict()).get(row_item.get('segment'))
+            self.markup_deduplicator.add((row_item.get('customer_profile_id'), model), predicted_value, row)
+
+    def _new_markup_result(self):
+        """ Empty result of markup preprocessing """
+        return {'success': 0, 'error': 0, 'rows': 0,
+                'markup_items': {field: [] for field in self.MARKUP_ITEMS_FIELDS},
+                'error_logs': {field: [] for field in self.ERROR_LOGS_FIELDS}}
+
+    def _preprocess_markup_rows(self, db_connect_data, rows):
+        """ Collect segments and search customer profiles for markup rows by chunks """
+        queries = PreparedQueries(db_connect_data)
+        result = self._new_markup_result()
+        search_name = self.SEARCH_NAMES.get(self.type)
+        chunk = self.CHUNK_SIZES.get(self.type)
+        data = list()
+        row_data = list()
+
+        for index, row in rows:
+            result['rows'] += 1
+            self.collect_segments(row.get('segment'), row.get('model'), row.get('predicted_value'))
+            if not search_name:
+                continue
+
+            if self.negative_cache is not None and f"{self.eshop_prefix}{row.get(search_name)}" in self.negative_cache:
+                result['error'] += 1
+                self._log_markup_error(result['error_logs'], row, search_name)
+                continue
+
+            if self.type == 'crm':
+                data.append(f"{self.eshop_prefix}{row.get(search_name)}")
+            else:
+                data.append(f"{row.get(search_name)}")
+            row_data.append(row)
+
+            if len(row_data) == chunk:
+                self._add_search_result(result, queries, data, row_data, search_name)
+                row_data = list()
+                data = list()
+
+        if row_data:
+            self._add_search_result(result, queries, data, row_data, search_name)
+        return result
+
+    def _add_search_result(self, result, queries, data, row_data, search_name):
+        """ Search customer profiles for chunk and add counters to result """
+        get_result = self._search_customer_profile_id(queries, data, row_data, search_name,
+                                                      result['error_logs'], result['markup_items'])
+        result['success'] += get_result['success']
+        result['error'] += get_result['error']
+        self._collect_markup_items(result['markup_items'])
+
+    def _log_markup_error(self, error_logs, row_item, search_name):
+        """ Add markup row without customer profile to error logs """
+        error_logs['id'].append(f"{self.eshop_prefix}{row_item.get(search_name)}")
+        error_logs['account_id'].append(self.account_id)
+        error_logs['eshop_id'].append(self.eshop_id)
+        error_logs['model'].append(row_item.get('model'))
+        error_logs['segment'].append(row_item.get('segment'))
+
+    def _load_negative_cache(self):
+        """ Load cache of customer ids without profiles, ids of profiles added since cache was saved are removed """
+        db_connect_data = connect_db()
+        profile_filter = str(self.eshop_id if self.type == 'crm' else self.account_id)
+        db_connect_data.cursor.execute(self.PROFILE_MAX_ID_QUERIES[self.type], (profile_filter,))
+        max_profile_id = db_connect_data.cursor.fetchone()[0]
+        cache_folder = f"models/{self.account_id}/negative_cache/"
+        negative_cache = NegativeLookupCache(self, f"{cache_folder}{self.type}.json.gz", max_profile_id,
+                                             int(os.getenv('NEGATIVE_CACHE_MAX_AGE_DAYS', 7)))
+        if negative_cache.path in self.get_list_objects_folder(cache_folder):
+            negative_cache.load()
+        if negative_cache.ids and negative_cache.loaded_max_profile_id < negative_cache.max_profile_id:
+            db_connect_data.cursor.execute(self.NEW_PROFILES_QUERIES[self.type],
+                                           (profile_filter, negative_cache.loaded_max_profile_id))
+            prefix = '' if self.type == 'crm' else self.eshop_prefix
+            new_profile_ids = [f"{prefix}{item[0]}" for item in db_connect_data.cursor.fetchall()]
+            negative_cache.discard(new_profile_ids)
+            print(f"Negative cache: {len(new_profile_ids)} profiles added since cache was saved")
+        db_connect_data.cursor.close()
+        print(f"Negative cache: {len(negative_cache)} customer ids without profiles")
+        return negative_cache
+
+    def _preprocess_markup_sharded(self, markup, columns, workers):
+        """ Split local copy of markup to shards aligned to chunk size, every worker process reads own shard """
+        markup_path = save_local(markup, f"{self.temp_dir.name}/{self.markup_file_name}")
+        chunk = self.CHUNK_SIZES[self.type]
+        shard_size = max(math.ceil(count_rows(markup_path, self.markup_file_name) / workers / chunk), 1) * chunk
+        shards = split_file(markup_path, self.markup_file_name, shard_size)
+        source = {'path': markup_path, 'file_name': self.markup_file_name, 'columns': columns,
+                  'numeric_categories': file_numeric_categories(markup_path, self.markup_file_name, columns),
+                  'spool_dir': self.temp_dir.name}
+        state = {'type': self.type, 'account_id': self.account_id, 'eshop_id': self.eshop_id,
+                 'eshop_prefix': self.eshop_prefix,
+                 'negative_cache': self.negative_cache.ids if self.negative_cache is not None else None}
+        print(f"Preprocess markup in {len(shards)} shards by {shard_size} rows")
+        result = self._new_markup_result()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for shard_result in executor.map(preprocess_markup_shard, [state] * len(shards),
+                                             [source] * len(shards), shards):
+                for counter_name in ('success', 'error', 'rows'):
+                    result[counter_name] += shard_result[counter_name]
+                for field, values in shard_result['error_logs'].items():
+                    result['error_logs'][field].extend(values)
+                for model, segments in shard_result['segments'].items():
+                    self.segments.setdefault(model, dict()).update(segments)
+                for rows in read_pickle_batches(shard_result['markup_spool']):
+                    self._deduplicate_rows(rows)
+                os.remove(shard_result['markup_spool'])
+                metrics.merge(shard_result['metrics'])
+        return result
+
     def generate_new_rules(self, rules):
         """ Generate new rules file """
         success_rules_counter = 0
@@ -145,7 +356,7 @@ class PreprocessML(Bucket, Logging):
         print("Start preprocess rules")
         rules_items = {'predicted_value': [], 'description': [], 'model': [], 'segment': []}
         error_logs = {'model': [], 'segment': []}
-        for rules_index, rules_item in pandas.read_csv(rules, delimiter=",").iterrows():
+        for rules_index, rules_item in iter_rows(rules, self.rules_file_name, RULES_COLUMNS):
             predicted_value = None
             if rules_item.get('model') in self.segments:
                 if rules_item.get('segment') in self.segments[rules_item.get('model')]:
@@ -168,6 +379,8 @@ class PreprocessML(Bucket, Logging):
         old_rule_path = f"{self.path_bucket_folder}/{self.timestamp}/{self.rules_file_name}"
         new_rule_path = f"{self.path_bucket_folder}/{self.timestamp}/preprocessed/{self.rules_file_name}"
         self.moving_file(old_rule_path, new_rule_path)
+        metrics.incr('rules.success', success_rules_counter)
+        metrics.incr('rules.error', error_rules_counter)
         print(f"Status adding rules: success - {success_rules_counter}, error - {error_rules_counter}")
         if success_rules_counter:
             print(f"Rules preprocessed - {success_rules_counter}")
@@ -178,8 +391,12 @@ class PreprocessML(Bucket, Logging):
 
     def save_file_in_temp(self, data, file_name):
         path = f"{self.temp_dir.name}/{file_name}"
-        df_markups = pandas.DataFrame(data)
-        df_markups.to_csv(path)
+        write_table(data, path)
+        self.add_file(path, f"{self.path_bucket_folder}/{self.timestamp}/{file_name}")
+
+    def save_rows_in_temp(self, rows, columns, file_name):
+        path = f"{self.temp_dir.name}/{file_name}"
+        write_rows(rows, columns, path)
         self.add_file(path, f"{self.path_bucket_folder}/{self.timestamp}/{file_name}")
 
     def collect_segments(self, segment_number, model, predicted_value):
@@ -189,25 +406,20 @@ class PreprocessML(Bucket, Logging):
         self.segments[model][segment_number] = predicted_value
         return self.segments
 
-    def _search_customer_profile_id(self, db_connect_data, data, data_row, search_name, error_logs, markup_items):
+    def _search_customer_profile_id(self, queries, data, data_row, search_name, error_logs, markup_items):
         """ Search customer profile id """
         success_markup_counter = 0
         error_markup_counter = 0
         customer_profile_items = None
         try:
-            query = ''
-            if self.type == 'crm':
-                query = f"""SELECT customer_profile_id, eshop_customer_id FROM data.customer_profile_crm 
-                WHERE eshop_customer_id IN ({','.join(data)}) AND eshop_id = '{self.eshop_id}'"""
-            elif self.type == 'beh':
-                query = f"""SELECT customer_profile_id, guest_id FROM data.customer_profile_behaviour 
-                WHERE guest_id IN ({','.join(data)}) AND account_id = '{self.account_id}'"""
-            db_connect_data.cursor.execute(query)
-            customer_profile_items = db_connect_data.cursor.fetchall()
+            search_filter = self.eshop_id if self.type == 'crm' else self.account_id
+            with metrics.timer('db.search_customer_profile_id'):
+                customer_profile_items = queries.fetchall(self.SEARCH_QUERIES[self.type],
+                                                          (array_literal(data), str(search_filter)))
         except Exception as e:
             print(e)
             error_markup_counter += len(data_row)
-        if customer_profile_items:
+        if customer_profile_items is not None:
             deleted_items = dict()
             for row_item in data_row:
                 check_row = False
@@ -233,18 +445,16 @@ class PreprocessML(Bucket, Logging):
                         success_markup_counter += 1
                     else:
                         error_markup_counter += 1
-                        error_logs['id'].append(f"{self.eshop_prefix}{row_item.get(search_name)}")
-                        error_logs['account_id'].append(self.account_id)
-                        error_logs['eshop_id'].append(self.eshop_id)
-                        error_logs['model'].append(row_item.get('model'))
-                        error_logs['segment'].append(row_item.get('segment'))
+                        self._log_markup_error(error_logs, row_item, search_name)
         else:
             error_markup_counter += 1
             print(f"Error during get customer profiles: {self.type}")
         return {'success': success_markup_counter, 'error': error_markup_counter}
 
+    @timed('http.get_eshop_data')
     def _get_eshop_data(self, account_id):
         """ Retrieve eshop data by account_id """
+        import requests
         url = f"{self.auth_api_url}/v1/accounts/{account_id}/eshop-api-keys"
         header = {"Authorization": self.auth_api_token}
         get_eshop_account = requests.get(url=url, headers=header)
@@ -257,3 +467,22 @@ class PreprocessML(Bucket, Logging):
         else:
             print(
                 f"Error during get account id: {account_id}, status_code: {get_eshop_account.status_code}")
+
+
+def preprocess_markup_shard(state, source, shard):
+    """ Read and preprocess markup shard in worker process with own DB connection """
+    metrics.reset()
+    preprocess = PreprocessML.__new__(PreprocessML)
+    preprocess.__dict__.update(state)
+    preprocess.segments = dict()
+    preprocess.markup_deduplicator = None
+    spool_handle, preprocess.markup_spool_path = tempfile.mkstemp(suffix='.pickle', dir=source['spool_dir'])
+    os.close(spool_handle)
+    db_connect_data = connect_db()
+    rows = iter_part_rows(source['path'], source['file_name'], source['columns'], shard, source['numeric_categories'])
+    result = preprocess._preprocess_markup_rows(db_connect_data, rows)
+    db_connect_data.cursor.close()
+    result['segments'] = preprocess.segments
+    result['markup_spool'] = preprocess.markup_spool_path
+    result['metrics'] = metrics.report()
+    return result
@@ -0,0 +1,129 @@
+from set_logging import Logging
+from bucket import Bucket, load_environment
+from instrumentation import metrics
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+
+
+class RetentionPolicy:
+    """ Model versions to keep: last keep_last versions and versions newer than keep_days """
+
+    def __init__(self, keep_last=2, keep_days=None):
+        self.keep_last = keep_last
+        self.keep_days = keep_days
+
+    def keep_reason(self, position, version, now):
+        """ Reason to keep version or None, position 0 is the newest version """
+        if self.keep_last and position < self.keep_last:
+            return 'keep_last'
+        if self.keep_days is not None and int(version) > datetime.timestamp(now - timedelta(days=self.keep_days)):
+            return 'keep_days'
+        return None
+
+
+class RetentionEngine(Bucket, Logging):
+    """ Plan and delete old model versions in bucket for all accounts """
+
+    def __init__(self, default_policy=None, policies=None, prefix='models', dry_run=False):
+        load_environment()
+        Bucket.__init__(self, os.getenv('AWS_BUCKET_NAME'))
+        Logging.__init__(self, '', "retention.log", __name__)
+        self.default_policy = default_policy or RetentionPolicy()
+        self.policies = policies or dict()
+        self.prefix = prefix
+        self.dry_run = dry_run
+
+    def get_policy(self, account_id, markup_type):
+        """ Policy for account and type, for account or default """
+        return self.policies.get(f"{account_id}/{markup_type}") or self.policies.get(str(account_id)) or \
+            self.default_policy
+
+    def list_versions(self):
+        """ Group keys by account, type and version from one paginated listing """
+        versions = dict()
+        for key in self.list_all_objects(f"{self.prefix}/"):
+            key_parts = key.split('/')
+            if len(key_parts) < 4 or not key_parts[3].isdigit():
+                continue
+            account_versions = versions.setdefault((key_parts[1], key_parts[2]), dict())
+            account_versions.setdefault(key_parts[3], list()).append(key)
+        return versions
+
+    @staticmethod
+    def get_active_versions():
+        """ Model versions of active account models by account """
+        from db.db import connect_db_data
+        import psycopg2.extras
+        db_connect_data = connect_db_data(cursor_factory=psycopg2.extras.DictCursor)
+        query = """ SELECT account_models.account_id, account_models.model_version
+        FROM data.active_account_models active_account_models
+        JOIN data.account_models account_models ON active_account_models.account_model_id = account_models.id """
+        db_connect_data.cursor.execute(query)
+        active_versions = dict()
+        for item in db_connect_data.cursor.fetchall():
+            active_versions.setdefault(str(item.get('account_id')), set()).add(str(item.get('model_version')))
+        db_connect_data.cursor.close()
+        return active_versions
+
+    def plan(self, now=None):
+        """ Versions to delete and versions kept with reason """
+        now = now or datetime.now()
+        active_versions = self.get_active_versions()
+        plan = {'delete': list(), 'keep': list()}
+        for (account_id, markup_type), account_versions in sorted(self.list_versions().items()):
+            policy = self.get_policy(account_id, markup_type)
+            for position, version in enumerate(sorted(account_versions, key=int, reverse=True)):
+                reason = policy.keep_reason(position, version, now)
+                if not reason and version in active_versions.get(account_id, set()):
+                    reason = 'active'
+                item = {'account_id': account_id, 'type': markup_type, 'version': version,
+                        'keys': account_versions[version]}
+                if reason:
+                    item['reason'] = reason
+                    plan['keep'].append(item)
+                else:
+                    plan['delete'].append(item)
+        return plan
+
+    def run(self, now=None):
+        """ Delete versions by plan, in dry run only report is returned """
+        plan = self.plan(now)
+        keys = [key for item in plan['delete'] for key in item['keys']]
+        report = {
+            'dry_run': self.dry_run,
+            'delete_versions': [f"{self.prefix}/{item['account_id']}/{item['type']}/{item['version']}"
+                                for item in plan['delete']],
+            'keep_versions': {f"{self.prefix}/{item['account_id']}/{item['type']}/{item['version']}": item['reason']
+                              for item in plan['keep']},
+            'delete_keys': len(keys),
+            'errors': list()
+        }
+        if not self.dry_run:
+            report['errors'] = self.delete_files(keys)
+        metrics.incr('retention.deleted_keys', len(keys) - len(report['errors']))
+        self.logger.info(f"Retention: delete versions - {len(plan['delete'])}, keys - {len(keys)}, "
+                         f"errors - {len(report['errors'])}, dry run - {self.dry_run}")
+        metrics.flush('retention', self.logger)
+        return report
+
+
+def load_policies(path):
+    """ Policies from json file: {"<account_id>": {...}, "<account_id>/<type>": {"keep_last": 2, "keep_days": 30}} """
+    with open(path) as policies_file:
+        return {name: RetentionPolicy(**policy) for name, policy in json.load(policies_file).items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete old model versions from bucket')
+    parser.add_argument('--keep-last', type=int, default=2)
+    parser.add_argument('--keep-days', type=int, default=None)
+    parser.add_argument('--policies', default=None)
+    parser.add_argument('--prefix', default='models')
+    parser.add_argument('--dry-run', action='store_true')
+    arguments = parser.parse_args()
+    engine = RetentionEngine(RetentionPolicy(arguments.keep_last, arguments.keep_days),
+                             load_policies(arguments.policies) if arguments.policies else None,
+                             arguments.prefix, arguments.dry_run)
+    print(json.dumps(engine.run(), indent=2))